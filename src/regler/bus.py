@@ -0,0 +1,199 @@
+"""
+bus - In-process publish/subscribe with MQTT topic semantics
+
+Components in one process exchange messages through the bus without the
+broker: a published message is put into the queue of every subscriber with
+a matching topic filter, the same message object for all of them.
+
+Only messages on the external topics are bridged to the broker, e.g. for
+hassio and the display. Messages from the broker are delivered for all
+topic filters of the subscribers, so settings and commands from outside
+still arrive. The bridge reconnects on its own, bridged messages are
+buffered while the broker is away.
+"""
+import asyncio
+from collections import deque, defaultdict
+
+from hbmqtt.client import MQTTClient, ClientException
+
+from topictree import TopicRouter
+from mqttconfig import clientConfig, SUBSCRIBE_QOS
+from connection import Connection
+
+
+BASE_TOPIC = "/house/heating"
+
+# topics consumed outside of the process
+EXTERNAL = [
+    'homeassistant/#',
+    BASE_TOPIC + '/sensors/temp/#',
+    BASE_TOPIC + '/state/#',
+]
+
+CLIENT_CONFIG = clientConfig(cleansession=False)  # don't miss data
+
+
+class Message(object):
+    """A message published on the bus
+
+    Looks like the message and the publish packet of hbmqtt, so it can be
+    used by code written for MQTTClient. The payload is not copied.
+    """
+
+    __slots__ = ('topic', 'data', 'qos', 'retain')
+
+    def __init__(self, topic, data, qos=None, retain=False):
+        self.topic = topic
+        self.data = data
+        self.qos = qos
+        self.retain = retain
+
+    @property
+    def publish_packet(self):
+        return self
+
+    @property
+    def variable_header(self):
+        return self
+
+    @property
+    def topic_name(self):
+        return self.topic
+
+    @property
+    def payload(self):
+        return self
+
+    @property
+    def retain_flag(self):
+        return self.retain
+
+
+class BusClient(object):
+    """Replaces MQTTClient for a component connected to the bus
+    """
+
+    def __init__(self, bus, client_id):
+        self.bus = bus
+        self.client_id = client_id
+        self.messages = asyncio.Queue()
+        self.filters = []
+
+    def deliver(self, topic, message):
+        self.messages.put_nowait(message)
+
+    @asyncio.coroutine
+    def connect(self, uri=None, *args, **kwargs):
+        if self.bus.stopping:
+            raise ClientException('bus is stopping')
+        return 0
+
+    @asyncio.coroutine
+    def subscribe(self, topics):
+        result = []
+        for topicFilter, qos in topics:
+            if topicFilter not in self.filters:
+                self.filters.append(topicFilter)
+                yield from self.bus.subscribe(topicFilter, self.deliver)
+            result.append(qos)
+        return result
+
+    @asyncio.coroutine
+    def unsubscribe(self, topics):
+        for topicFilter in topics:
+            if topicFilter in self.filters:
+                self.filters.remove(topicFilter)
+                self.bus.unsubscribe(topicFilter, self.deliver)
+
+    @asyncio.coroutine
+    def publish(self, topic, message, qos=None, retain=None):
+        yield from self.bus.publish(topic, message, qos, bool(retain))
+
+    @asyncio.coroutine
+    def deliver_message(self, timeout=None):
+        message = yield from asyncio.wait_for(self.messages.get(), timeout)
+        return message
+
+    @asyncio.coroutine
+    def disconnect(self):
+        yield from self.unsubscribe(list(self.filters))
+
+
+class Bus(object):
+    """The subscribers of the process and the bridge to the broker
+
+    Without a broker URI the bus only works in the process.
+    """
+
+    def __init__(self, uri=None, external=EXTERNAL):
+        self.uri = uri
+        self.client = None
+        self.stopping = False
+        self.router = TopicRouter()
+        self.external = TopicRouter([(f, True) for f in external])
+        # topic -> bridged to the broker, the number of topics is small
+        self.bridged = {}
+        # payloads bridged to subscribed topics, the broker echoes them
+        self.echoes = defaultdict(deque)
+        if uri is not None:
+            self.client = Connection(
+                MQTTClient, BASE_TOPIC + "/bus", CLIENT_CONFIG)
+
+    def clientFactory(self, client_id, config=None):
+        return BusClient(self, client_id)
+
+    @asyncio.coroutine
+    def subscribe(self, topicFilter, handler):
+        new = topicFilter not in self.router.filters
+        self.router.add(topicFilter, handler)
+        if new and self.client is not None:
+            yield from self.client.subscribe(
+                [(topicFilter, SUBSCRIBE_QOS)])
+
+    def unsubscribe(self, topicFilter, handler):
+        # the broker subscription is kept, unmatched messages are dropped
+        self.router.remove(topicFilter, handler)
+
+    def isExternal(self, topic):
+        bridged = self.bridged.get(topic)
+        if bridged is None:
+            bridged = self.bridged[topic] = bool(self.external.match(topic))
+        return bridged
+
+    @asyncio.coroutine
+    def publish(self, topic, data, qos=None, retain=False):
+        # like the broker, live messages are delivered without retain flag
+        receivers = self.router.dispatch(topic, Message(topic, data, qos))
+        if self.client is None or not self.isExternal(topic):
+            return
+        if receivers:
+            self.echoes[topic].append(data)
+        yield from self.client.publish(topic, data, qos=qos, retain=retain)
+
+    def isEcho(self, topic, data):
+        echoes = self.echoes.get(topic)
+        if not echoes or data not in echoes:
+            return False
+        # older payloads were dropped from the outbox of the bridge
+        while echoes.popleft() != data:
+            pass
+        if not echoes:
+            del self.echoes[topic]
+        return True
+
+    @asyncio.coroutine
+    def run(self):
+        """Bridge to the broker, returns at once without a broker
+        """
+        if self.client is None:
+            return
+        yield from self.client.connect(self.uri)
+        try:
+            while True:
+                message = yield from self.client.deliver_message()
+                packet = message.publish_packet
+                topic = packet.variable_header.topic_name
+                if not self.isEcho(topic, packet.payload.data):
+                    self.router.dispatch(topic, message)
+        finally:
+            yield from self.client.disconnect()
@@ -0,0 +1,209 @@
+"""
+connection - MQTT connection which reconnects and buffers while offline
+
+The connection is kept in the background: after a failure the next attempt
+follows after an exponential backoff with jitter, the subscriptions are
+renewed and the messages published while offline are sent in order. The
+outbox is bounded, when it is full the oldest message is dropped.
+
+A Connection has the methods of MQTTClient used by the modules, so the
+code using it doesn't change.
+"""
+import random
+import asyncio
+import logging
+from collections import deque
+
+
+# seconds, the delay doubles after every failed attempt
+BACKOFF_MIN = 0.5
+BACKOFF_MAX = 30.0
+
+# messages kept while offline
+OUTBOX_SIZE = 1000
+
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+DISCONNECTED = 'disconnected'
+CLOSED = 'closed'
+
+
+class Connection(object):
+
+    def __init__(self, factory, clientId, config, subscriptions=(),
+                 onConnect=None, outboxSize=OUTBOX_SIZE):
+        self.factory = factory
+        self.clientId = clientId
+        self.config = config
+        self.subscriptions = list(subscriptions)
+        self.onConnect = onConnect
+        self.uri = None
+        self.client = None
+        self.task = None
+        self.state = CLOSED
+        self.connected = asyncio.Event()
+        self.messages = asyncio.Queue()
+        self.outbox = deque()
+        self.outboxSize = outboxSize
+        self.attempts = 0
+        self.connects = 0
+        self.failures = 0
+        self.dropped = 0
+        self.lastError = None
+        self.since = None
+
+    def health(self):
+        return {
+            "state": self.state,
+            "connects": self.connects,
+            "failures": self.failures,
+            "last_error": self.lastError,
+            "outbox": len(self.outbox),
+            "dropped": self.dropped,
+        }
+
+    def setState(self, state):
+        if state != self.state:
+            logging.info('%s: %s', self.clientId, state)
+            self.state = state
+            self.since = asyncio.get_event_loop().time()
+
+    def backoff(self):
+        """Equal jitter, between half and all of the exponential delay
+        """
+        delay = min(BACKOFF_MAX, BACKOFF_MIN * 2 ** self.attempts)
+        self.attempts += 1
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def failed(self, e):
+        self.setState(DISCONNECTED)
+        self.connected.clear()
+        self.failures += 1
+        self.lastError = str(e) or e.__class__.__name__
+        logging.error('%s: %s', self.clientId, self.lastError)
+
+    @asyncio.coroutine
+    def connect(self, uri):
+        """Start to connect, publishes are buffered until connected
+        """
+        self.uri = uri
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.maintain())
+        return 0
+
+    @asyncio.coroutine
+    def open(self):
+        self.setState(CONNECTING)
+        self.client = self.factory(self.clientId, config=self.config)
+        yield from self.client.connect(self.uri)
+        if self.subscriptions:
+            yield from self.client.subscribe(self.subscriptions)
+        self.attempts = 0
+        self.connects += 1
+        self.connected.set()
+        self.setState(CONNECTED)
+        yield from self.replay()
+        if self.onConnect is not None:
+            yield from self.onConnect(self)
+
+    @asyncio.coroutine
+    def maintain(self, delay=0):
+        while True:
+            yield from asyncio.sleep(delay)
+            try:
+                yield from self.open()
+                while True:
+                    message = yield from self.client.deliver_message()
+                    self.messages.put_nowait(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed(e)
+            yield from self.close(self.client)
+            delay = self.backoff()
+
+    @asyncio.coroutine
+    def reconnect(self, client):
+        yield from self.close(client)
+        yield from self.maintain(self.backoff())
+
+    @asyncio.coroutine
+    def close(self, client):
+        try:
+            yield from client.disconnect()
+        except Exception:
+            pass
+
+    @asyncio.coroutine
+    def replay(self):
+        while self.outbox and self.connected.is_set():
+            topic, payload, qos, retain = self.outbox[0]
+            yield from self.client.publish(
+                topic, payload, qos=qos, retain=retain)
+            self.outbox.popleft()
+
+    def buffer(self, message):
+        if len(self.outbox) >= self.outboxSize:
+            self.outbox.popleft()
+            self.dropped += 1
+        self.outbox.append(message)
+
+    @asyncio.coroutine
+    def subscribe(self, topics):
+        for topic in topics:
+            if topic not in self.subscriptions:
+                self.subscriptions.append(topic)
+        if self.connected.is_set():
+            yield from self.client.subscribe(topics)
+
+    @asyncio.coroutine
+    def unsubscribe(self, topics):
+        self.subscriptions = [
+            s for s in self.subscriptions if s[0] not in topics]
+        if self.connected.is_set():
+            yield from self.client.unsubscribe(topics)
+
+    @asyncio.coroutine
+    def publish(self, topic, payload, qos=None, retain=None):
+        message = (topic, payload, qos, retain)
+        if self.outbox or not self.connected.is_set():
+            # keep the order, the outbox is sent first on reconnect
+            self.buffer(message)
+            return
+        try:
+            yield from self.client.publish(
+                topic, payload, qos=qos, retain=retain)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.buffer(message)
+            if not self.connected.is_set():
+                return  # another publish failed before
+            self.failed(e)
+            # the delivery of the lost client doesn't end on its own
+            if self.task is not None:
+                self.task.cancel()
+                self.task = asyncio.ensure_future(
+                    self.reconnect(self.client))
+
+    @asyncio.coroutine
+    def deliver_message(self, timeout=None):
+        message = yield from asyncio.wait_for(self.messages.get(), timeout)
+        return message
+
+    @asyncio.coroutine
+    def disconnect(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.connected.is_set():
+            try:
+                yield from self.replay()
+                yield from self.client.disconnect()
+            except Exception as e:
+                logging.error('%s: %s', self.clientId, e)
+        self.connected.clear()
+        self.setState(CLOSED)
+        if self.outbox:
+            logging.warning('%s: %s messages not sent',
+                            self.clientId, len(self.outbox))
@@ -0,0 +1,186 @@
+"""
+curvefit - Fit the heating curve to logged data
+Usage:
+    curvefit [-h | --help]
+    curvefit [options]
+
+Options:
+    -h --help           Show this screen.
+    --log=FILE          log written by mqttlogger
+                        [default: /var/log/house/mqtt.log]
+    --settings=FILE     current settings, other values are kept
+                        [default: /etc/house/settings.json]
+    --from=TS           first timestamp, e.g. 2019-11-01T00:00:00Z
+    --to=TS             last timestamp
+    --piecewise         fit a curve with an additional slope below a knee
+    --a-offsets=LIST    changes of a tried around the fit
+                        [default: -0.04:0.04:0.02]
+    --b-offsets=LIST    changes of b tried around the fit [default: -2:2:0.5]
+    --tolerance=LIST    tolerances to evaluate [default: 0.5:3:0.25]
+    --band=K            comfort band around the fitted flow temperature
+                        [default: 2.0]
+    --max-violations=F  max share of time outside the band [default: 0.05]
+    --max-cycle=SEC     ignore longer pump cycles [default: 43200]
+    --step=SEC          interval of the control loop [default: 30]
+    --workers=N         number of processes, defaults to the CPU count
+
+Every pump cycle (start to next start) gives one point: the mean outside air
+temperature and the mean flow temperature the house was held at. The curve
+`a * oat + b` is fitted to these points with least squares weighted by the
+cycle length.
+
+The held flow temperature is what the controller was told to hold, so the
+fit only finds the curve which was active, it says nothing about pump
+cycling. It serves as the comfort reference and the starting point: the
+simulator then tries the a and b offsets around it and afterwards the
+tolerances, and the candidate with the fewest pump starts which keeps the
+flow temperature within the band around the fitted curve for the required
+share of the time wins. Without room temperatures in the log the fitted
+curve is the best available target, a house which was kept too warm stays
+too warm.
+
+Prints a settings line which can be appended to the settings file.
+"""
+import os
+import sys
+import json
+import docopt
+from datetime import datetime
+
+import numpy as np
+
+import simulator
+from settingsstore import SettingsStore
+from tsstore import parseTimestamp
+
+
+def cycles(data, maxCycle=43200):
+    """Mean outside air and flow temperature and length of all pump cycles
+    """
+    pump = np.nan_to_num(data['pump']) > 0
+    starts = np.flatnonzero(pump[1:] & ~pump[:-1]) + 1
+    if len(starts) < 2:
+        raise ValueError('not enough pump cycles in the log')
+    oat = data['oat']
+    flow = data['flow']
+    valid = np.isfinite(oat) & np.isfinite(flow)
+    counts = np.add.reduceat(valid.astype(np.int64), starts)[:-1]
+    oatSum = np.add.reduceat(np.where(valid, oat, 0.0), starts)[:-1]
+    flowSum = np.add.reduceat(np.where(valid, flow, 0.0), starts)[:-1]
+    length = np.diff(starts) * data['step']
+    keep = (counts > 0) & (length <= maxCycle)
+    counts = counts[keep]
+    return oatSum[keep] / counts, flowSum[keep] / counts, length[keep]
+
+
+def designMatrices(oat, knees):
+    """One design matrix per knee, a knee of None is a straight line
+    """
+    ones = np.ones_like(oat)
+    if knees is None:
+        return np.column_stack([oat, ones])[np.newaxis]
+    return np.stack([
+        np.column_stack([oat, ones, np.minimum(oat - knee, 0.0)])
+        for knee in knees
+    ])
+
+
+def fitCurve(oat, flow, weights, piecewise=False):
+    """Weighted least squares fit of the heating curve
+
+    The normal equations of all knee candidates are solved in one batch.
+    Returns the settings of the curve and the RMS error.
+    """
+    knees = None
+    if piecewise:
+        knees = np.percentile(oat, np.linspace(10, 90, 17))
+    X = designMatrices(oat, knees)
+    XtW = X.transpose(0, 2, 1) * weights
+    coef = np.linalg.solve(XtW @ X, (XtW @ flow)[..., np.newaxis])[..., 0]
+    residuals = flow - np.einsum('kij,kj->ki', X, coef)
+    errors = np.sqrt((residuals ** 2 * weights).sum(axis=1) / weights.sum())
+    best = int(np.argmin(errors))
+    curve = {
+        "a": round(float(coef[best, 0]), 4),
+        "b": round(float(coef[best, 1]), 2),
+    }
+    if knees is not None:
+        curve["knee"] = round(float(knees[best]), 1)
+        curve["a2"] = round(float(coef[best, 2]), 4)
+    return curve, float(errors[best])
+
+
+def requiredFlow(curve, oat):
+    """The flow temperature of a curve for every outside air temperature
+    """
+    flow = curve['a'] * oat + curve['b']
+    if 'knee' in curve:
+        flow += curve['a2'] * np.minimum(oat - curve['knee'], 0.0)
+    return flow
+
+
+def choose(results, maxViolations):
+    """The result with the fewest starts which holds the comfort band
+    """
+    accepted = [
+        r for r in results if r['comfort_violations'] <= maxViolations]
+    if not accepted:
+        sys.stderr.write('no candidate holds the band, using the best\n')
+        accepted = results
+    return min(accepted, key=lambda r: (r['starts'], r['comfort_violations']))
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    settings = SettingsStore(arguments['--settings']).latest() or {}
+    start = end = None
+    if arguments['--from']:
+        start = parseTimestamp(arguments['--from'])
+    if arguments['--to']:
+        end = parseTimestamp(arguments['--to'])
+    data = simulator.loadData(
+        arguments['--log'], start, end, int(arguments['--step']))
+    oat, flow, length = cycles(data, int(arguments['--max-cycle']))
+    curve, error = fitCurve(
+        oat, flow, length.astype(np.float64), arguments['--piecewise'])
+    sys.stderr.write('%s cycles, curve %s, rms error %.2f\n' % (
+        len(oat), curve, error))
+    settings.pop('knee', None)
+    settings.pop('a2', None)
+    settings.update(curve)
+    required = requiredFlow(curve, data['oat']).tolist()
+    plant = simulator.fitPlant(data)
+    band = float(arguments['--band'])
+    maxViolations = float(arguments['--max-violations'])
+    workers = None
+    if arguments['--workers']:
+        workers = int(arguments['--workers'])
+    workers = workers or os.cpu_count()
+    # first the curve at the current tolerance, then the tolerance
+    settings.setdefault('tolerance', 1.0)
+    candidates = []
+    for da in simulator.parseCandidates(arguments['--a-offsets'], 0.0):
+        for db in simulator.parseCandidates(arguments['--b-offsets'], 0.0):
+            candidate = dict(settings)
+            candidate['a'] = round(curve['a'] + da, 4)
+            candidate['b'] = round(curve['b'] + db, 2)
+            candidates.append(candidate)
+    best = choose(
+        simulator.sweep(candidates, data, plant, workers, band, required),
+        maxViolations)
+    sys.stderr.write('curve %s\n' % best)
+    settings['a'] = best['a']
+    settings['b'] = best['b']
+    candidates = []
+    for tolerance in simulator.parseCandidates(
+            arguments['--tolerance'], settings['tolerance']):
+        candidate = dict(settings)
+        candidate['tolerance'] = tolerance
+        candidates.append(candidate)
+    best = choose(
+        simulator.sweep(candidates, data, plant, workers, band, required),
+        maxViolations)
+    sys.stderr.write('tolerance %s\n' % best)
+    settings['tolerance'] = best['tolerance']
+    settings['modified'] = datetime.now().isoformat()
+    print(json.dumps(settings))
@@ -12,6 +12,7 @@ import os
 import time
 import json
 import docopt
+from collections import OrderedDict
 try:
     import Queue as queue
 except Exception:
@@ -23,8 +24,25 @@ import paho.mqtt.client as mqtt
 
 
 # Colours
+BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+
+WIDTH = 320
+HEIGHT = 240
+
+# seconds between two frames while an age bar grows, without bars the
+# display only waits for values and events
+FRAME = 0.3
+IDLE = 1.0
+
+# the age bar grows 10 pixels per second
+BAR_SPEED = 10
+BAR_HEIGHT = 3
+
+# rendered texts kept, the display shows a few dozen
+GLYPHS = 256
 
 os.putenv('SDL_FBDEV', '/dev/fb1')
 
@@ -69,13 +87,178 @@ TS = {
 }
 
 
+class GlyphCache(object):
+    """Rendered text surfaces, the least recently used are dropped
+    """
+
+    def __init__(self, size=GLYPHS):
+        self.size = size
+        self.surfaces = OrderedDict()
+
+    def render(self, font, text, color):
+        key = (font, text, color)
+        surface = self.surfaces.get(key)
+        if surface is None:
+            surface = font.render(text, True, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+
+class Renderer(object):
+    """Draws only what changed and updates only the changed rectangles
+
+    The cells remember their text and rectangle, a changed text clears the
+    old rectangle. The age bars are drawn on top of the text, a shrinking
+    bar draws the text below it again.
+    """
+
+    def __init__(self, lcd, font_big, font_half):
+        self.lcd = lcd
+        self.font_big = font_big
+        self.font_half = font_half
+        self.glyphs = GlyphCache()
+        right = font_half.size('-99.9')[0] + 3
+        self.colOffsets = [
+            0,
+            -(WIDTH - right),
+            -WIDTH,
+        ]
+        self.lineHeight = font_big.size('L')[1] + 1
+        # (line, col, lineOffset) -> (text, color, rect, surface)
+        self.cells = {}
+        # line -> length of the age bar
+        self.bars = {}
+        self.dirty = []
+
+    def text(self, line, col, text, color, font=None, lineOffset=0):
+        font = font or self.font_big
+        key = (line, col, lineOffset)
+        old = self.cells.get(key)
+        if old is not None and old[0] == text and old[1] == color:
+            return
+        surface = self.glyphs.render(font, text, color)
+        size = surface.get_size()
+        pos = [self.colOffsets[col], line * self.lineHeight]
+        if pos[0] < 0:
+            pos[0] = -pos[0] - size[0]
+        pos[1] += size[1] * lineOffset
+        rect = pygame.Rect(pos, size)
+        if old is not None:
+            self.lcd.fill(BLACK, old[2])
+            self.dirty.append(old[2])
+        self.lcd.blit(surface, rect)
+        self.dirty.append(rect)
+        self.cells[key] = (text, color, rect, surface)
+        if line in self.bars:
+            # the text may have covered the bar
+            self.drawBar(line, 0, self.bars[line], GREEN)
+
+    def drawBar(self, line, start, end, color):
+        rect = pygame.Rect(
+            start, (line + 1) * self.lineHeight - 5, end - start, BAR_HEIGHT)
+        self.lcd.fill(color, rect)
+        if color == BLACK:
+            self.redrawText(line, rect)
+        self.dirty.append(rect)
+
+    def redrawText(self, line, rect):
+        """Blit the text of the line again where it meets the rectangle
+        """
+        for key, (text, color, cell, surface) in self.cells.items():
+            if key[0] != line or not cell.colliderect(rect):
+                continue
+            clip = cell.clip(rect)
+            self.lcd.blit(surface, clip, clip.move(-cell.x, -cell.y))
+
+    def bar(self, line, ts, now):
+        length = 0
+        if ts is not None:
+            length = int((now - ts) * BAR_SPEED)
+            if length > WIDTH:
+                length = 0
+        old = self.bars.get(line, 0)
+        if length > old:
+            self.drawBar(line, old, length, GREEN)
+        elif length < old:
+            self.drawBar(line, length, old, BLACK)
+        self.bars[line] = length
+
+    def line(self, line, text, color, value=None, up=None, down=None,
+             ts=None, now=None):
+        self.text(line, 0, text, color)
+        if value is not None:
+            self.text(line, 1, value, color)
+        if up is not None:
+            self.text(line, 2, up, color, self.font_half)
+        if down is not None:
+            self.text(line, 2, down, color, self.font_half, 1)
+        self.bar(line, ts, now)
+
+    def animating(self):
+        return any(self.bars.values())
+
+    def update(self):
+        if self.dirty:
+            pygame.display.update(self.dirty)
+            self.dirty = []
+
+
+def draw(renderer, now):
+    textColor = WHITE
+    if not VALUES.get('connected', False):
+        textColor = RED
+
+    state = VALUES.get('state', {})
+    settings = state.get('settings', {})
+    nominal = float(state.get('nominal') or 0.0)
+    tolerance = float(settings.get('tolerance', 0.0))
+    nominal_min = nominal - tolerance
+    nominal_max = nominal + tolerance
+    a = float(settings.get('a', 0.0))
+    b = float(settings.get('b', 0.0))
+
+    renderer.line(0,
+                  'Luft',
+                  textColor,
+                  '%.1f' % VALUES.get('air', 0.0),
+                  ts=TS.get('air'),
+                  now=now)
+    renderer.line(1,
+                  'Soll',
+                  textColor,
+                  value='%.1f' % nominal,
+                  up='%.1f' % nominal_max,
+                  down='%.1f' % nominal_min,
+                  ts=TS.get('state'),
+                  now=now)
+    renderer.line(2,
+                  'Ist',
+                  textColor,
+                  '%.1f' % VALUES.get('flow', 0.0),
+                  ts=TS.get('flow'),
+                  now=now)
+    text = '-'
+    pump_state = state.get('heat_pump')
+    if pump_state == 1:
+        text = 'EIN'
+    elif pump_state == 0:
+        text = 'AUS'
+    renderer.line(3, 'Pumpe', textColor, text, ts=TS.get('state'), now=now)
+    renderer.text(
+        4, 2, '%.2f*t + %.2f' % (a, b), textColor, renderer.font_half, 1)
+
+
 def run(arguments):
     global VALUES, QUEUE
 
     pygame.init()
     pygame.mouse.set_visible(False)
-    lcd = pygame.display.set_mode((320, 240))
-    lcd.fill((0, 0, 0))
+    lcd = pygame.display.set_mode((WIDTH, HEIGHT))
+    lcd.fill(BLACK)
     pygame.display.update()
     font_big = pygame.font.Font(None, 60)
     font_half = pygame.font.Font(None, 30)
@@ -96,97 +279,29 @@ def run(arguments):
     client.loop_start()
 
     try:
-        right = font_half.size('-99.9')[0] + 3
-        colOffsets = [
-            0,
-            -(320 - right),
-            -320,
-        ]
-        lineHeight = font_big.size('L')[1] + 1
-        while True:
-            name = None
+        renderer = Renderer(lcd, font_big, font_half)
+        running = True
+        while running:
+            timeout = FRAME if renderer.animating() else IDLE
             try:
-                name, value = QUEUE.get(timeout=0.3)
+                name, value = QUEUE.get(timeout=timeout)
+                while True:
+                    VALUES[name] = value
+                    TS[name] = time.time()
+                    # all values which arrived meanwhile, one frame
+                    name, value = QUEUE.get_nowait()
             except queue.Empty:
                 pass
-            ev = pygame.event.poll()
-            if ev.type == pygame.QUIT:
-                break
-            if name is not None:
-                VALUES[name] = value
-                TS[name] = time.time()
-
-            lcd.fill((0, 0, 0))
-
-            textColor = WHITE
-            if not VALUES.get('connected', False):
-                textColor = RED
-
-            def drawCol(line, col, text, font=font_big, lineOffset=0):
-                text_surface = font.render(text, True, textColor)
-                size = font.size(text)
-                pos = [colOffsets[col], line * lineHeight]
-                if pos[0] < 0:
-                    pos[0] = -pos[0] - size[0]
-                pos[1] += size[1] * lineOffset
-                lcd.blit(text_surface, pygame.Rect(pos, size))
-
-            def showLine(line, text, value=None, up=None, down=None, ts=None):
-                drawCol(line, 0, text)
-                if value is not None:
-                    drawCol(line, 1, value)
-                if up is not None:
-                    drawCol(line, 2, up, font_half)
-                if down is not None:
-                    drawCol(line, 2, down, font_half, 1)
-                if ts is not None:
-                    length = int((time.time() - ts) * 10)
-                    if length <= 320:
-                        pygame.draw.rect(
-                            lcd,
-                            (0, 255, 0),
-                            pygame.Rect(
-                                0, (line + 1) * lineHeight - 5,
-                                length, 3)
-                        )
-
-            state = VALUES.get('state', {})
-            settings = state.get('settings', {})
-            nominal = float(state.get('nominal', 0.0))
-            tolerance = float(settings.get('tolerance', 0.0))
-            nominal_min = nominal - tolerance
-            nominal_max = nominal + tolerance
-            a = float(settings.get('a', 0.0))
-            b = float(settings.get('b', 0.0))
-
-            showLine(0,
-                     'Luft',
-                     '%.1f' % VALUES.get('air', 0.0),
-                     ts=TS.get('air'))
-            showLine(1,
-                     'Soll',
-                     value='%.1f' % nominal,
-                     up='%.1f' % nominal_max,
-                     down='%.1f' % nominal_min,
-                     ts=TS.get('state'))
-            showLine(2,
-                     'Ist',
-                     '%.1f' % VALUES.get('flow', 0.0),
-                     ts=TS.get('flow'))
-            text = '-'
-            pump_state = state.get('heat_pump')
-            if pump_state == 1:
-                text = 'EIN'
-            elif pump_state == 0:
-                text = 'AUS'
-            showLine(3, 'Pumpe', text, ts=TS.get('state'))
-            drawCol(4, 2, '%.2f*t + %.2f' % (a, b), font_half, 1)
-
-            pygame.display.update()
+            for ev in pygame.event.get():
+                if ev.type == pygame.QUIT:
+                    running = False
+            draw(renderer, time.time())
+            renderer.update()
     finally:
         client.loop_stop()
         pygame.quit()
 
+
 if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
     run(arguments)
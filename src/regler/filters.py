@@ -0,0 +1,75 @@
+"""
+filters - Smoothing and outlier rejection for sensor values
+
+Every sensor gets its own filter with a fixed size ring buffer, so adding a
+sample is O(1) and the memory doesn't grow. A sample which changes faster
+than the rate limit is rejected unless the change persists for a few
+samples, then it is a real step. Without a sample for the timeout the value
+becomes None.
+"""
+from collections import deque
+
+
+class SensorFilter(object):
+
+    __slots__ = (
+        'samples', 'method', 'alpha', 'maxRate', 'timeout', 'maxRejects',
+        'output', 'last', 'lastTs', 'rejects', 'rejected',
+    )
+
+    def __init__(self, window=5, method='median', alpha=0.3, maxRate=None,
+                 timeout=None, maxRejects=3):
+        if method not in ('median', 'ema'):
+            raise ValueError('unknown filter method %r' % method)
+        self.samples = deque(maxlen=window)
+        self.method = method
+        self.alpha = alpha
+        self.maxRate = maxRate
+        self.timeout = timeout
+        self.maxRejects = maxRejects
+        self.rejected = 0
+        self.reset()
+
+    def reset(self):
+        self.samples.clear()
+        self.output = None
+        self.last = None
+        self.lastTs = None
+        self.rejects = 0
+
+    def add(self, value, now):
+        """Add a raw sample, returns the filtered value
+        """
+        if self.maxRate is not None and self.last is not None:
+            dt = max(now - self.lastTs, 1.0)
+            if (abs(value - self.last) > self.maxRate * dt
+                    and self.rejects < self.maxRejects):
+                self.rejects += 1
+                self.rejected += 1
+                return self.current(now)
+        self.rejects = 0
+        self.last = value
+        self.lastTs = now
+        self.samples.append(value)
+        if self.method == 'ema':
+            if self.output is None:
+                self.output = value
+            else:
+                self.output += self.alpha * (value - self.output)
+        else:
+            ordered = sorted(self.samples)
+            self.output = ordered[len(ordered) // 2]
+        return self.output
+
+    def current(self, now, timeout=None):
+        """The filtered value, None if the sensor is quiet for too long
+
+        A timeout given replaces the one of the filter.
+        """
+        if self.lastTs is None:
+            return None
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None and (now - self.lastTs) > timeout:
+            return None
+        return self.output
@@ -0,0 +1,346 @@
+"""
+forecast - Outside air temperature forecast for the nominal calculation
+Usage:
+    forecast [-h | --help]
+    forecast backtest [options]
+
+Options:
+    -h --help           Show this screen.
+    --log=FILE          log written by mqttlogger
+                        [default: /var/log/house/mqtt.log]
+    --settings=FILE     settings of the backtest
+                        [default: /etc/house/settings.json]
+    --from=TS           first timestamp, e.g. 2019-11-01T00:00:00Z
+    --to=TS             last timestamp
+    --step=SEC          interval of the control loop [default: 30]
+    --plant=MODEL       "model" or "replay", see simulator [default: model]
+    --forecast-log=FILE
+                        replay the forecasts logged by mqttlogger,
+                        see below
+    --lag=SEC           thermal lag of the house, defaults to the
+                        forecast_lag setting
+    --interval=SEC      interval of the forecast points [default: 3600]
+    --noise=K           standard deviation of the forecast error
+                        [default: 0.5]
+    --seed=N            seed of the forecast error [default: 1]
+
+A forecast is a JSON list of `[timestamp, temperature]` points, the
+timestamp in seconds or like `2019-11-16T11:00:00Z`. Like the sensor values
+it is prefixed with the time it was issued, e.g.
+`2019-11-16T11:00:00Z,[["2019-11-16T12:00:00Z", 3.5], ...]`. It is
+published to `/house/heating/forecast/outside_air_temp` or written to the
+file given to regler with `--forecast`. A forecast without the issue time
+counts as issued at its first point, at most at the time it was received.
+
+The house reacts to the outside air temperature with a lag, so the nominal
+is calculated from the mean of the forecast over the next hours, weighted
+with exp(-t / lag). Only the change of the forecast is used, the measured
+outside air temperature corrects the bias of the forecast.
+
+Settings, all optional:
+
+    forecast_lag      thermal lag of the house in seconds, 0 disables the
+                      forecast [default: 10800]
+    forecast_max_age  ignore older forecasts, seconds [default: 21600]
+
+The backtest replays the log twice through the simulator, without and with
+a forecast, and counts the steps the flow temperature is outside the
+tolerance around the nominal the house actually needed: the curve at the
+lag weighted outside air temperature.
+
+Without `--forecast-log` the forecast is made from that same logged outside
+air temperature plus noise. The forecast knows the future, so the result is
+a best case bound for a forecast with perfect foresight, not what a real
+forecast achieves. `--forecast-log` replays the forecasts mqttlogger logged,
+each one from the time it was received, and measures the real forecast.
+"""
+import os
+import csv
+import sys
+import json
+import math
+import random
+import logging
+from bisect import bisect_right
+
+import logwriter
+from tsstore import parseTimestamp, formatTimestamp
+
+
+FORECAST_TOPIC = '/house/heating/forecast/outside_air_temp'
+
+
+# resolution of the lag kernel and of the cache, seconds
+KERNEL_STEP = 600
+CACHE_STEP = 60
+
+
+def kernel(lag):
+    """Offsets and normalised weights of the lag kernel
+    """
+    steps = int(3 * lag // KERNEL_STEP) + 1
+    weights = [math.exp(-i * KERNEL_STEP / lag) for i in range(steps)]
+    total = sum(weights)
+    return [(i * KERNEL_STEP, w / total) for i, w in enumerate(weights)]
+
+
+def parsePoints(data):
+    points = []
+    for ts, value in json.loads(data):
+        if isinstance(ts, str):
+            ts = parseTimestamp(ts)
+        points.append((float(ts), float(value)))
+    points.sort()
+    return points
+
+
+def parseForecast(data, received):
+    """The issue time and the points of a forecast
+    """
+    data = data.strip()
+    if data.startswith('['):
+        points = parsePoints(data)
+        issued = received
+        if points:
+            # a retained forecast may be old
+            issued = min(received, points[0][0])
+        return issued, points
+    ts, _, points = data.partition(',')
+    return parseTimestamp(ts), parsePoints(points)
+
+
+class Forecast(object):
+
+    def __init__(self):
+        self.ts = []
+        self.values = []
+        self.issued = None
+        self.mtime = None
+        self.kernels = {}
+        self.cached = (None, None)
+
+    def update(self, points, issued):
+        self.ts = [p[0] for p in points]
+        self.values = [p[1] for p in points]
+        self.issued = issued
+        self.cached = (None, None)
+
+    def updateFromFile(self, path):
+        """Reload the file if it changed, errors keep the old forecast
+        """
+        try:
+            mtime = os.stat(path).st_mtime
+            if mtime == self.mtime:
+                return
+            self.mtime = mtime
+            with open(path) as f:
+                issued, points = parseForecast(f.read(), mtime)
+            self.update(points, issued)
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning('forecast %s: %s', path, e)
+
+    def fresh(self, now, settings):
+        if len(self.ts) < 2 or self.ts[-1] <= now:
+            return False
+        if self.issued is None:
+            # made by the backtest, never expires
+            return True
+        maxAge = float(settings.get('forecast_max_age', 21600))
+        return (now - self.issued) <= maxAge
+
+    def at(self, ts):
+        """Linear interpolation, constant outside of the forecast
+        """
+        i = bisect_right(self.ts, ts)
+        if i == 0:
+            return self.values[0]
+        if i == len(self.ts):
+            return self.values[-1]
+        t0 = self.ts[i - 1]
+        v0 = self.values[i - 1]
+        return v0 + (self.values[i] - v0) * (ts - t0) / (self.ts[i] - t0)
+
+    def change(self, now, lag):
+        """Lag weighted forecast minus the forecast for now
+        """
+        key = (int(now // CACHE_STEP), lag)
+        if self.cached[0] == key:
+            return self.cached[1]
+        weights = self.kernels.get(lag)
+        if weights is None:
+            weights = self.kernels[lag] = kernel(lag)
+        now = key[0] * CACHE_STEP
+        weighted = sum(w * self.at(now + offset) for offset, w in weights)
+        change = weighted - self.at(now)
+        self.cached = (key, change)
+        return change
+
+    def effective(self, oat, now, settings):
+        """The outside air temperature the nominal is calculated for
+        """
+        lag = float(settings.get('forecast_lag', 10800))
+        if lag <= 0 or not self.fresh(now, settings):
+            return oat
+        return oat + self.change(now, lag)
+
+
+class ReplayedForecast(Forecast):
+    """Logged forecasts, each one is used from the time it was received
+    """
+
+    def __init__(self, forecasts):
+        Forecast.__init__(self)
+        # (received, points) sorted by the time received
+        self.forecasts = forecasts
+        self.received = [f[0] for f in forecasts]
+        self.current = None
+
+    def fresh(self, now, settings):
+        i = bisect_right(self.received, now) - 1
+        if i < 0:
+            return False
+        if i != self.current:
+            self.current = i
+            self.update(self.forecasts[i][1], self.received[i])
+        return Forecast.fresh(self, now, settings)
+
+
+def loadForecasts(log, start=None, end=None):
+    """The forecasts received in [start, end] as (received, points)
+
+    Rows which aren't valid forecasts are skipped, older versions of
+    mqttlogger logged forecasts without the time received.
+    """
+    forecasts = []
+    for name in logwriter.segments(
+            log,
+            start is not None and formatTimestamp(start) or None,
+            end is not None and formatTimestamp(end) or None,
+            FORECAST_TOPIC):
+        with logwriter.openSegment(name) as f:
+            for row in csv.reader(f):
+                if len(row) != 3 or row[2] != FORECAST_TOPIC:
+                    continue
+                try:
+                    received = parseTimestamp(row[0])
+                    points = parsePoints(row[1])
+                except (ValueError, TypeError):
+                    continue
+                if start is not None and received < start:
+                    continue
+                if end is not None and received > end:
+                    continue
+                forecasts.append((received, points))
+    forecasts.sort(key=lambda f: f[0])
+    return forecasts
+
+
+def lagged(values, step, lag):
+    """Lag weighted mean of the following values, the backtest reference
+    """
+    alpha = math.exp(-step / lag)
+    result = [float('nan')] * len(values)
+    y = None
+    for i in range(len(values) - 1, -1, -1):
+        v = values[i]
+        if v == v:
+            y = v if y is None else (1 - alpha) * v + alpha * y
+        result[i] = y if y is not None else float('nan')
+    return result
+
+
+def backtestForecast(data, interval, noise, seed):
+    """A forecast made from the logged outside air temperature
+
+    Apart from the noise it is the reference of the backtest, it gives the
+    best case with perfect foresight.
+    """
+    rnd = random.Random(seed)
+    points = []
+    for ts, oat in zip(data['ts'].tolist(), data['oat'].tolist()):
+        if oat == oat and (not points or ts - points[-1][0] >= interval):
+            points.append((float(ts), oat + rnd.gauss(0.0, noise)))
+    forecast = Forecast()
+    forecast.update(points, None)
+    return forecast
+
+
+def backtest(settings, data, plant, forecast, name='forecast'):
+    """Simulate without and with the forecast, one result per input
+
+    The reference is the curve at the lag weighted logged outside air
+    temperature. Against a forecast made from that temperature the result
+    is a best case bound, a replayed forecast measures the real one.
+    """
+    import simulator
+    step = data['step']
+    lag = float(settings.get('forecast_lag', 10800))
+    a = float(settings['a'])
+    b = float(settings['b'])
+    required = [
+        a * oat + b for oat in lagged(data['oat'].tolist(), step, lag)]
+    results = []
+    for inputName, f in (('measured', None), (name, forecast)):
+        result = simulator.simulate(
+            settings, data, plant, required=required, forecast=f)
+        result['input'] = inputName
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    import docopt
+    import simulator
+    from settingsstore import SettingsStore
+
+    arguments = docopt.docopt(__doc__)
+    settings = SettingsStore(arguments['--settings']).latest()
+    if settings is None:
+        settings = {"a": -0.2, "b": 28, "tolerance": 1.0}
+    if arguments['--lag']:
+        settings['forecast_lag'] = float(arguments['--lag'])
+    if float(settings.get('forecast_lag', 10800)) <= 0:
+        sys.exit('forecast_lag must be positive for the backtest')
+    start = end = None
+    if arguments['--from']:
+        start = parseTimestamp(arguments['--from'])
+    if arguments['--to']:
+        end = parseTimestamp(arguments['--to'])
+    data = simulator.loadData(
+        arguments['--log'], start, end, int(arguments['--step']))
+    plant = None
+    if arguments['--plant'] == 'model':
+        plant = simulator.fitPlant(data)
+    if arguments['--forecast-log']:
+        maxAge = float(settings.get('forecast_max_age', 21600))
+        first = int(data['ts'][0])
+        forecasts = loadForecasts(
+            arguments['--forecast-log'], first - maxAge, int(data['ts'][-1]))
+        if not forecasts:
+            sys.exit('no forecasts in %s' % arguments['--forecast-log'])
+        forecast = ReplayedForecast(forecasts)
+        name = 'logged'
+    else:
+        forecast = backtestForecast(
+            data,
+            int(arguments['--interval']),
+            float(arguments['--noise']),
+            int(arguments['--seed']),
+        )
+        name = 'foresight'
+        sys.stderr.write(
+            'forecast made from the logged outside air temperature, the '
+            'result is a best case\nbound with perfect foresight, use '
+            '--forecast-log for the real forecast\n')
+    results = backtest(settings, data, plant, forecast, name)
+    out = csv.DictWriter(
+        sys.stdout, ['input'] + simulator.METRICS + ['comfort_violations'],
+        extrasaction='ignore')
+    out.writeheader()
+    out.writerows(results)
+    before = results[0]['comfort_violations']
+    after = results[1]['comfort_violations']
+    if before:
+        sys.stderr.write('comfort band violations reduced by %.1f%%%s\n' % (
+            100.0 * (before - after) / before,
+            ' (best case)' if name == 'foresight' else ''))
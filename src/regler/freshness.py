@@ -0,0 +1,89 @@
+"""
+freshness - Detect stale sensors and run the heat pump in fail-safe mode
+
+A sensor is stale if it didn't deliver a sample for `stale_after` seconds,
+a sensor which never delivered one counts from the start of the monitor.
+While a sensor is stale the pump follows the fail-safe mode instead of the
+strategy.
+
+Settings, all optional:
+
+    stale_after      max age of a sensor sample in seconds [default: 300]
+    failsafe         "off" or the duty cycle of the pump, e.g. 0.3
+                     [default: off]
+    failsafe_period  period of the fail-safe duty cycle in seconds
+                     [default: 1800]
+"""
+import logging
+
+
+PUMP_ON = 1
+PUMP_OFF = 0
+
+ALARM_NONE = -1
+ALARM_STALE_SENSOR = 1
+
+
+class FreshnessMonitor(object):
+
+    def __init__(self):
+        self.started = None
+        self.since = None
+        self.stale = []
+
+    def lastSample(self, sensor):
+        if sensor.updated is None:
+            return self.started
+        return sensor.updated
+
+    def check(self, sensors, now, settings):
+        """Returns the names of the stale sensors
+        """
+        if self.started is None:
+            self.started = now
+        maxAge = float(settings.get('stale_after', 300))
+        stale = sorted(
+            name for name, sensor in sensors.items()
+            if (now - self.lastSample(sensor)) >= maxAge)
+        if stale != self.stale:
+            if stale:
+                logging.error('stale sensors %s, fail-safe mode', stale)
+            else:
+                logging.info('all sensors fresh again')
+        if stale and not self.stale:
+            self.since = now
+        elif not stale:
+            self.since = None
+        self.stale = stale
+        return stale
+
+    def expiresAt(self, sensors, settings):
+        """The earliest time a fresh sensor becomes stale, None if unknown
+        """
+        if self.started is None:
+            return None
+        maxAge = float(settings.get('stale_after', 300))
+        expires = [
+            self.lastSample(sensor) + maxAge
+            for name, sensor in sensors.items()
+            if name not in self.stale
+        ]
+        if not expires:
+            return None
+        return min(expires)
+
+    def failsafe(self, now, settings):
+        """The pump state of the fail-safe mode
+        """
+        mode = settings.get('failsafe', 'off')
+        if mode == 'off':
+            return PUMP_OFF
+        try:
+            duty = min(max(float(mode), 0.0), 1.0)
+        except ValueError:
+            logging.warning('invalid failsafe %r, switching off', mode)
+            return PUMP_OFF
+        period = float(settings.get('failsafe_period', 1800))
+        if ((now - self.since) % period) < duty * period:
+            return PUMP_ON
+        return PUMP_OFF
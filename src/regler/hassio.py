@@ -7,160 +7,327 @@ Usage:
 Options:
     -h --help           Show this screen.
     --uri=<mqttclient>  MQTT broker URI [default: mqtt://localhost]
+
+The entities and their discovery configs are generated from registry.py,
+the entities of a zone are announced when its first value arrives. The
+configs are retained, a config is only published if the retained one
+differs.
+
+Settings changed in Home Assistant are checked against the limits of their
+entity and forwarded to regler, at most every COMMAND_INTERVAL seconds,
+the last value wins.
 """
 import asyncio
+import logging
 import docopt
-import json
 
-from hbmqtt.client import MQTTClient, ClientException
-from hbmqtt.mqtt.constants import QOS_2
+from hbmqtt.client import MQTTClient
 
+from topictree import TopicRouter
+from mqttconfig import clientConfig, publish, subscriptions
+from connection import Connection
+from registry import (
+    DEFAULT_ZONE, CONFIG_TOPICS, COMMAND_TOPICS, entities, parseTopic,
+    configHash, topicFilters, validate,
+)
 
-HOUSE_BASE_TOPIC = "/house/heating"
 
-CLIENT_CONFIG = {
-    "default_qos": QOS_2,
-    "broker": {
-        "cleansession": False  # don't miss data
-    }
-}
+CLIENT_CONFIG = clientConfig(cleansession=False)  # don't miss data
 
+# creates the MQTT client, replaced by the supervisor
+client_factory = MQTTClient
 
-@asyncio.coroutine
-def binarySensorHandler(settings, client, packet):
-    [ts, state] = packet.payload.data.decode('utf-8').split(',', 1)
-    state = 'OFF' if state == '0' else 'ON'
-    yield from client.publish(
-        settings['topicBase'] + 'state',
-        bytes(state, 'utf-8'),
-        qos=QOS_2,
-    )
+# the topics of an entity are always published by the same worker, so its
+# config and states stay in order while other entities don't wait for it
+WORKERS = 4
+QUEUE_SIZE = 100
 
+# seconds after which an unchanged state is sent again, e.g. for a
+# restarted Home Assistant
+REFRESH = 600
 
-@asyncio.coroutine
-def tempSensorHandler(settings, client, packet):
-    [ts, value] = packet.payload.data.decode('utf-8').split(',', 1)
-    yield from client.publish(
-        settings['topicBase'] + 'state',
-        bytes(value, 'utf-8'),
-        qos=QOS_2,
-    )
+# seconds to send the queued states on shutdown
+STOP_TIMEOUT = 5
+
+# seconds to receive the retained configs after a connect
+DISCOVERY_DELAY = 2
+
+# seconds between two changes of a setting from Home Assistant
+COMMAND_INTERVAL = 2
+
+
+def binarySensorHandler(entity, value):
+    return 'OFF' if value in entity['off'] else 'ON'
+
+
+def valueHandler(entity, value):
+    return value
 
 
 HANDLERS = {
-    HOUSE_BASE_TOPIC + '/actors/heat_pump': {
-        "active": True,
-        "handler": binarySensorHandler,
-        "topicBase": "homeassistant/binary_sensor/house/heat_pump/",
-        "config": {
-            "name": "Heizung Wärmepumpe",
-            "unique_id": "house_sensor_heat_pump",
-            "state_topic": "homeassistant/binary_sensor/house/heat_pump/state",
-            "payload_available": "true",
-            "payload_not_available": "false",
-            "payload_on": "ON",
-            "payload_off": "OFF",
-            "device": {
-                "manufacturer": "selbst",
-                "model": "heizung",
-                "name": "Heizung",
-                "identifiers": [
-                    "heizung1"
-                ]
-            }
-        },
-    },
-    HOUSE_BASE_TOPIC + '/sensors/temp/outside_air_temp': {
-        "active": True,
-        "handler": tempSensorHandler,
-        "topicBase": "homeassistant/sensor/house/outside_air_temp/",
-        "config": {
-            "name": "Heizung Aussentemperatur",
-            "unique_id": "house_sensor_outside_air",
-            "state_topic": "homeassistant/sensor/house/outside_air_temp/state",
-            "value_template": "{{ value | float | round(1) }}",
-            "unit_of_measurement": "°C",
-            "device_class": "temperature",
-            "device": {
-                "manufacturer": "selbst",
-                "model": "heizung",
-                "name": "Heizung",
-                "identifiers": [
-                    "heizung1"
-                ]
-            }
-        },
-    },
-    HOUSE_BASE_TOPIC + '/sensors/temp/flow': {
-        "active": True,
-        "handler": tempSensorHandler,
-        "topicBase": "homeassistant/sensor/house/flow/",
-        "config": {
-            "name": "Heizung Wassertemperatur",
-            "unique_id": "house_sensor_flow",
-            "state_topic": "homeassistant/sensor/house/flow/state",
-            "value_template": "{{ value | float | round(1) }}",
-            "unit_of_measurement": "°C",
-            "device_class": "temperature",
-            "device": {
-                "manufacturer": "selbst",
-                "model": "heizung",
-                "name": "Heizung",
-                "identifiers": [
-                    "heizung1"
-                ]
-            }
-        },
-    }
+    'binary_sensor': binarySensorHandler,
 }
 
-SUBSCRIPTIONS = [
-    (name, QOS_2)
-    for name, settings in HANDLERS.items()
-    if settings['active']
-]
+
+class Publisher(object):
+    """Publishes the states in workers, skips states sent before
+    """
+
+    def __init__(self, client, workers=WORKERS, size=QUEUE_SIZE):
+        self.client = client
+        self.queues = [asyncio.Queue(size) for i in range(workers)]
+        self.tasks = []
+        # topic -> (payload, time sent)
+        self.last = {}
+        self.skipped = 0
+
+    def start(self):
+        self.tasks = [
+            asyncio.ensure_future(self.work(queue)) for queue in self.queues
+        ]
+
+    @asyncio.coroutine
+    def stop(self):
+        yield from asyncio.wait(
+            [asyncio.ensure_future(queue.join()) for queue in self.queues],
+            timeout=STOP_TIMEOUT,
+        )
+        for task in self.tasks:
+            task.cancel()
+        if self.tasks:
+            yield from asyncio.wait(self.tasks)
+
+    def reset(self):
+        self.last.clear()
+
+    @asyncio.coroutine
+    def put(self, topic, payload):
+        """Queue a state, waits while the queue of the topic is full
+        """
+        now = asyncio.get_event_loop().time()
+        last = self.last.get(topic)
+        if last is not None and last[0] == payload and \
+                now - last[1] < REFRESH:
+            self.skipped += 1
+            return
+        self.last[topic] = (payload, now)
+        entity = topic.rsplit('/', 1)[0]
+        queue = self.queues[hash(entity) % len(self.queues)]
+        yield from queue.put((topic, payload))
+
+    @asyncio.coroutine
+    def work(self, queue):
+        while True:
+            topic, payload = yield from queue.get()
+            try:
+                yield from publish(self.client, topic, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error('[%s] %s', topic, e)
+            finally:
+                queue.task_done()
+
+
+# house topic -> entity, None for topics without entity
+known = {}
+# zones with announced entities
+zones = set()
+# config topic -> entity
+configs = {}
+# config topic -> hash of the config retained by the broker
+retained = {}
+# config topics published but not received back yet
+unconfirmed = set()
+# state topic -> state, waiting for the config of the entity
+pending = {}
+# time to publish the changed configs, None if they are up to date
+sync_at = None
+
+
+def addZone(zone):
+    # run is started again by the supervisor
+    if zone in zones:
+        return
+    zones.add(zone)
+    for e in entities(zone):
+        known[e['source']] = e
+        configs[e['topicBase'] + 'config'] = e
+        if 'target' in e:
+            settable[e['topicBase'] + 'set'] = e
+
+
+def lookup(topic):
+    if topic not in known:
+        known[topic] = None
+        parsed = parseTopic(topic)
+        if parsed is not None and parsed[0] not in zones:
+            logging.info('new zone %s', parsed[0])
+            addZone(parsed[0])
+    return known[topic]
 
 
 @asyncio.coroutine
-def publishConfig(client, settings):
-    yield from client.publish(
-        settings['topicBase'] + 'config',
-        bytes(json.dumps(settings['config']), 'utf-8'),
-        qos=QOS_2,
-        retain=True,
-    )
+def syncConfigs(publisher):
+    global sync_at
+    sync_at = None
+    for topic, e in configs.items():
+        if retained.get(topic) != e['hash']:
+            logging.info('config %s', topic)
+            retained[topic] = e['hash']
+            unconfirmed.add(topic)
+            yield from publisher.put(topic, e['payload'])
+    for topic, state in pending.items():
+        yield from publisher.put(topic, state)
+    pending.clear()
+
+
+class Throttle(object):
+    """Forwards the last payload of a topic at most every interval seconds
+    """
+
+    def __init__(self, interval=COMMAND_INTERVAL):
+        self.interval = interval
+        # topic -> time of the last forward
+        self.sent = {}
+        # topic -> payload
+        self.waiting = {}
+
+    def put(self, topic, payload):
+        self.waiting[topic] = payload
+
+    def nextAt(self, topic):
+        sent = self.sent.get(topic)
+        if sent is None:
+            return 0
+        return sent + self.interval
+
+    def dueAt(self):
+        """Time of the next forward, None if nothing waits
+        """
+        if not self.waiting:
+            return None
+        return min(self.nextAt(topic) for topic in self.waiting)
+
+    def due(self, now):
+        result = []
+        for topic, payload in list(self.waiting.items()):
+            if now >= self.nextAt(topic):
+                del self.waiting[topic]
+                self.sent[topic] = now
+                result.append((topic, payload))
+        return result
+
+
+# set topic -> entity of the settings
+settable = {}
+throttle = Throttle()
+
+
+def changeSetting(topic, data):
+    e = settable.get(topic)
+    if e is None:
+        return
+    try:
+        value = validate(e, data.decode('utf-8').strip())
+    except ValueError as err:
+        logging.warning('[%s] invalid value: %s', topic, err)
+        return
+    throttle.put(e['target'], bytes(value, 'utf-8'))
+
+
+@asyncio.coroutine
+def announce(client, publisher):
+    global sync_at
+    # Home Assistant may have restarted, send all states again
+    publisher.reset()
+    # the broker sends the retained configs after the subscribe
+    sync_at = asyncio.get_event_loop().time() + DISCOVERY_DELAY
+
+
+@asyncio.coroutine
+def forward(publisher, packet):
+    topic = packet.topic_name
+    if CONFIG_ROUTER.match(topic):
+        retained[topic] = configHash(packet.payload.data)
+        unconfirmed.discard(topic)
+        return
+    if COMMAND_ROUTER.match(topic):
+        changeSetting(topic, packet.payload.data)
+        return
+    e = lookup(topic)
+    if e is None:
+        return
+    row = packet.payload.data.decode('utf-8').split(',', 1)
+    logging.debug('%s %s', topic, row)
+    if len(row) != 2:
+        logging.warning('[%s] invalid payload %r', topic, row)
+        return
+    state = HANDLERS.get(e['component'], valueHandler)(e, row[1])
+    stateTopic = e['topicBase'] + 'state'
+    if retained.get(e['topicBase'] + 'config') != e['hash']:
+        # Home Assistant drops the states of unknown entities
+        pending[stateTopic] = bytes(state, 'utf-8')
+        if sync_at is None:
+            # a new zone
+            yield from syncConfigs(publisher)
+        return
+    yield from publisher.put(stateTopic, bytes(state, 'utf-8'))
+
+
+CONFIG_ROUTER = TopicRouter([(CONFIG_TOPICS, True)])
+COMMAND_ROUTER = TopicRouter([(COMMAND_TOPICS, True)])
+SUBSCRIPTIONS = subscriptions(
+    topicFilters() + [CONFIG_TOPICS, COMMAND_TOPICS])
 
 
 @asyncio.coroutine
 def run(arguments):
-    alive = True
-    while alive:
-        C = MQTTClient(
-            "hassio/test",
-            config=CLIENT_CONFIG,
-        )
-        yield from C.connect(arguments['--uri'])
-        yield from C.subscribe(SUBSCRIPTIONS)
-        for settings in HANDLERS.values():
-            if settings['active']:
-                yield from publishConfig(C, settings)
-        try:
-            while True:
-                message = yield from C.deliver_message()
-                packet = message.publish_packet
-                topic = packet.topic_name
-                if topic in HANDLERS:
-                    settings = HANDLERS[topic]
-                    yield from settings['handler'](settings, C, packet)
-                    row = packet.payload.data.decode('utf-8').split(',', 1)
-                    print(packet.topic_name, row)
-        except KeyboardInterrupt:
-            alive = False
-        except ClientException as ce:
-            print("Client exception: %s" % ce)
-            yield from C.unsubscribe([s[0] for s in SUBSCRIPTIONS])
-        finally:
-            yield from C.disconnect()
+    addZone(DEFAULT_ZONE)
+    # run is started again by the supervisor, the subscriptions of the bus
+    # stay and the broker doesn't send the retained configs again. The
+    # configs lost with the old publisher are published again.
+    for topic in unconfirmed:
+        retained.pop(topic, None)
+    unconfirmed.clear()
+    pending.clear()
+    C = Connection(
+        client_factory,
+        "hassio/test",
+        CLIENT_CONFIG,
+        SUBSCRIPTIONS,
+        onConnect=lambda C: announce(C, publisher),
+    )
+    publisher = Publisher(C)
+    publisher.start()
+    yield from C.connect(arguments['--uri'])
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            deadlines = [
+                t for t in (sync_at, throttle.dueAt()) if t is not None]
+            timeout = None
+            if deadlines:
+                timeout = max(0, min(deadlines) - loop.time())
+            try:
+                message = yield from C.deliver_message(timeout=timeout)
+                yield from forward(publisher, message.publish_packet)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception('Unknown exception: %s', e)
+            if sync_at is not None and loop.time() >= sync_at:
+                yield from syncConfigs(publisher)
+            for topic, payload in throttle.due(loop.time()):
+                logging.info('setting %s %s', topic, payload)
+                yield from publish(C, topic, payload)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        yield from publisher.stop()
+        yield from C.disconnect()
 
 
 if __name__ == '__main__':
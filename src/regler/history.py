@@ -0,0 +1,228 @@
+"""
+history - Query logged sensor data
+Usage:
+    history [-h | --help]
+    history <topic> [options]
+
+Options:
+    -h --help           Show this screen.
+    --log=FILE          log written by sensorlogger or mqttlogger
+                        [default: /var/log/house/temps.log]
+    --from=TS           first timestamp, e.g. 2019-11-16T00:00:00Z
+    --to=TS             last timestamp
+    --bucket=SIZE       bucket size 1m, 15m, 1h or 1d [default: 1h]
+    --cache=DIR         directory for cached rollups of rotated segments
+                        [default: /var/cache/house/history]
+    --no-cache          don't read or write cached rollups
+
+Prints one CSV row per bucket: start, min, max, mean, count.
+
+Rotated segments never change, their one minute rollups are cached so
+longer queries only parse the segments which aren't cached yet and the live
+log file. Buckets are aligned to UTC, the query range is applied with one
+minute resolution.
+"""
+import os
+import csv
+import sys
+import hashlib
+import logging
+import docopt
+
+import numpy as np
+
+import logwriter
+from tsstore import parseTimestamp, formatTimestamp
+
+
+BUCKETS = {
+    '1m': 60,
+    '15m': 900,
+    '1h': 3600,
+    '1d': 86400,
+}
+BASE_BUCKET = 60
+
+
+def readSamples(name, topic):
+    """All samples of a topic in one log file as (ts, values) arrays
+    """
+    timestamps = []
+    values = []
+    with logwriter.openSegment(name) as f:
+        for row in csv.reader(f):
+            if len(row) >= 3 and row[-1] == topic:
+                timestamps.append(row[0].rstrip('Z').split('.', 1)[0])
+                values.append(row[1])
+    ts = np.array(timestamps, dtype='datetime64[s]').astype(np.int64)
+    try:
+        v = np.array(values, dtype=np.float64)
+    except ValueError:
+        v = np.array([toFloat(value) for value in values], dtype=np.float64)
+        valid = ~np.isnan(v)
+        ts, v = ts[valid], v[valid]
+    return ts, v
+
+
+def toFloat(value):
+    try:
+        return float(value)
+    except ValueError:
+        return np.nan
+
+
+def loadSeries(log, topic, start=None, end=None):
+    """The raw samples of a topic in [start, end] sorted by time
+
+    start and end are seconds, the result are (ts, values) arrays.
+    """
+    parts = [
+        readSamples(name, topic)
+        for name in logwriter.segments(
+            log,
+            start is not None and formatTimestamp(start) or None,
+            end is not None and formatTimestamp(end) or None,
+            topic)
+    ]
+    if not parts:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    ts = np.concatenate([p[0] for p in parts])
+    values = np.concatenate([p[1] for p in parts])
+    order = np.argsort(ts, kind='stable')
+    ts, values = ts[order], values[order]
+    mask = np.ones(len(ts), dtype=bool)
+    if start is not None:
+        mask &= ts >= start
+    if end is not None:
+        mask &= ts <= end
+    return ts[mask], values[mask]
+
+
+def rollup(ts, values, size):
+    """Aggregate samples to buckets (start, min, max, sum, count)
+    """
+    if not len(ts):
+        return emptyRollup()
+    order = np.argsort(ts, kind='stable')
+    keys = ts[order] // size * size
+    values = values[order]
+    starts, index = np.unique(keys, return_index=True)
+    return (
+        starts,
+        np.minimum.reduceat(values, index),
+        np.maximum.reduceat(values, index),
+        np.add.reduceat(values, index),
+        np.diff(np.append(index, len(keys))),
+    )
+
+
+def mergeRollups(parts, size):
+    """Combine rollups of a smaller bucket size to a bigger one
+    """
+    parts = [p for p in parts if len(p[0])]
+    if not parts:
+        return emptyRollup()
+    starts, mins, maxs, sums, counts = [
+        np.concatenate([p[i] for p in parts]) for i in range(5)]
+    order = np.argsort(starts, kind='stable')
+    keys = starts[order] // size * size
+    buckets, index = np.unique(keys, return_index=True)
+    return (
+        buckets,
+        np.minimum.reduceat(mins[order], index),
+        np.maximum.reduceat(maxs[order], index),
+        np.add.reduceat(sums[order], index),
+        np.add.reduceat(counts[order], index),
+    )
+
+
+def emptyRollup():
+    return (
+        np.zeros(0, dtype=np.int64),
+        np.zeros(0),
+        np.zeros(0),
+        np.zeros(0),
+        np.zeros(0, dtype=np.int64),
+    )
+
+
+def cachePath(cache, name, topic):
+    key = hashlib.sha1(topic.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache, '%s.%s.npz' % (os.path.basename(name), key))
+
+
+def segmentRollup(name, topic, cache=None):
+    """The base rollup of one log file
+
+    Rollups of rotated segments are read from and written to the cache,
+    the live log file is always parsed.
+    """
+    path = None
+    if cache is not None and name.endswith(
+            tuple(logwriter.COMPRESSORS.values())):
+        path = cachePath(cache, name, topic)
+        if os.path.exists(path):
+            with np.load(path) as data:
+                return tuple(data['r%s' % i] for i in range(5))
+    result = rollup(*readSamples(name, topic), size=BASE_BUCKET)
+    if path is not None:
+        try:
+            os.makedirs(cache, exist_ok=True)
+            tmp = path + '.tmp.npz'
+            np.savez(tmp, **{'r%s' % i: a for i, a in enumerate(result)})
+            os.replace(tmp, path)
+        except OSError:
+            logging.exception('history: caching %s failed', path)
+    return result
+
+
+def query(log, topic, start=None, end=None, bucket='1h', cache=None):
+    """min/max/mean buckets of a topic
+
+    Returns the arrays (start, min, max, mean, count).
+    """
+    size = BUCKETS[bucket]
+    parts = []
+    for name in logwriter.segments(
+            log,
+            start is not None and formatTimestamp(start) or None,
+            end is not None and formatTimestamp(end) or None,
+            topic):
+        part = segmentRollup(name, topic, cache)
+        mask = np.ones(len(part[0]), dtype=bool)
+        if start is not None:
+            mask &= part[0] >= start // BASE_BUCKET * BASE_BUCKET
+        if end is not None:
+            mask &= part[0] <= end
+        parts.append(tuple(a[mask] for a in part))
+    starts, mins, maxs, sums, counts = mergeRollups(parts, size)
+    return starts, mins, maxs, sums / np.maximum(counts, 1), counts
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    start = end = None
+    if arguments['--from']:
+        start = parseTimestamp(arguments['--from'])
+    if arguments['--to']:
+        end = parseTimestamp(arguments['--to'])
+    cache = None
+    if not arguments['--no-cache']:
+        cache = arguments['--cache']
+    result = query(
+        arguments['--log'],
+        arguments['<topic>'],
+        start,
+        end,
+        arguments['--bucket'],
+        cache,
+    )
+    out = csv.writer(sys.stdout)
+    for ts, low, high, mean, count in zip(*result):
+        out.writerow([
+            formatTimestamp(int(ts)),
+            '%.2f' % low,
+            '%.2f' % high,
+            '%.2f' % mean,
+            count,
+        ])
@@ -0,0 +1,332 @@
+"""
+logwriter - Buffered CSV writer for the MQTT loggers
+
+Rows are collected in memory and written in batches, either when the batch
+is full or when the oldest buffered row reached the maximum latency. This
+trades durability for fewer writes on the SD card: rows still in the buffer
+are lost if the process is killed.
+
+The counters are kept in `<output>.stats` which is written every
+STATS_INTERVAL seconds, on rotation and on close, not on every flush. A run
+which didn't close the writer leaves `clean: false` behind, the next run
+counts it as an unclean shutdown and rebuilds the time range and topics of
+the live output from the file. Rows which couldn't be written are counted
+as lost. The rows still buffered at a crash are not counted, that would
+need a write per row: up to the batch size or the latency of data is gone
+and the counters miss up to STATS_INTERVAL seconds.
+
+The output is rotated by day or size. A closed segment is renamed to
+`<output>.<YYYYmmdd-HHMMSS>` and compressed in a background thread. Every
+segment gets a line in `<output>.index` with the time range and the topics
+it contains, readers use `segments` to only open the files they need.
+"""
+import os
+import csv
+import gzip
+import json
+import time
+import shutil
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# seconds between writes of the stats
+STATS_INTERVAL = 300
+
+COMPRESSORS = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+
+def parseRotation(rotate):
+    """Parse "day", "none" or a size like "50M" to (daily, max bytes)
+    """
+    if not rotate or rotate == 'none':
+        return False, None
+    if rotate == 'day':
+        return True, None
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    factor = units.get(rotate[-1].upper())
+    if factor is not None:
+        return False, int(rotate[:-1]) * factor
+    return False, int(rotate)
+
+
+def newSegment():
+    return {
+        "day": None,
+        "start": None,
+        "end": None,
+        "topics": [],
+        "rows": 0,
+    }
+
+
+def compressFile(src, compress):
+    dst = src + COMPRESSORS[compress]
+    tmp = dst + '.tmp'
+    with open(src, 'rb') as fin:
+        if compress == 'zstd':
+            with open(tmp, 'wb') as fout:
+                zstandard.ZstdCompressor().copy_stream(fin, fout)
+        else:
+            with gzip.open(tmp, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+    os.replace(tmp, dst)
+    os.remove(src)
+
+
+class BufferedWriter(object):
+
+    def __init__(self, path, batchSize=500, maxLatency=5.0,
+                 rotate=None, compress='gzip'):
+        self.path = path
+        self.batchSize = batchSize
+        self.maxLatency = maxLatency
+        self.daily, self.maxSize = parseRotation(rotate)
+        if compress == 'none':
+            compress = None
+        if compress == 'zstd' and zstandard is None:
+            logging.warning('logwriter: zstandard not installed, using gzip')
+            compress = 'gzip'
+        self.compress = compress
+        self.compressor = ThreadPoolExecutor(max_workers=1)
+        self.rows = []
+        self.first = None
+        self.statsPath = path + '.stats'
+        self.indexPath = path + '.index'
+        self.stats = self.readStats()
+        if not self.stats.get('clean', True):
+            self.stats['unclean_shutdowns'] += 1
+            logging.warning(
+                'logwriter: %s was not closed, up to %s rows or %ss of data '
+                'may be lost', path, batchSize, maxLatency)
+            self.rebuildSegment()
+        self.stats['clean'] = False
+        self.open()
+        self.writeStats()
+        self.recompress()
+
+    def open(self):
+        self.file = open(self.path, 'a', newline='', buffering=1 << 16)
+        self.writer = csv.writer(self.file, lineterminator='\n')
+
+    def readStats(self):
+        stats = {
+            "written": 0,
+            "lost": 0,
+            "flushes": 0,
+            "unclean_shutdowns": 0,
+            "clean": True,
+            "segment": newSegment(),
+        }
+        try:
+            with open(self.statsPath, 'r') as f:
+                stats.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return stats
+
+    def writeStats(self):
+        tmp = self.statsPath + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.stats, f)
+        os.replace(tmp, self.statsPath)
+        self.statsWritten = time.time()
+
+    def rebuildSegment(self):
+        """The segment of the live output, the stats may be older
+        """
+        day = self.stats['segment']['day']
+        self.stats['segment'] = newSegment()
+        rows = []
+        try:
+            with open(self.path, 'r', newline='') as f:
+                for row in csv.reader(f):
+                    if row:
+                        rows.append(row)
+                    if len(rows) >= 10000:
+                        self.updateSegment(rows)
+                        rows = []
+        except IOError:
+            pass
+        if rows:
+            self.updateSegment(rows)
+        if day is not None:
+            self.stats['segment']['day'] = day
+
+    def writerow(self, row):
+        if self.first is None:
+            self.first = time.time()
+        self.rows.append(row)
+        if len(self.rows) >= self.batchSize:
+            self.flush()
+
+    def timeout(self):
+        """Seconds until the buffer must be flushed, None if it is empty
+        """
+        if self.first is None:
+            return None
+        return max(0, self.first + self.maxLatency - time.time())
+
+    def flushDue(self):
+        timeout = self.timeout()
+        if timeout is not None and timeout <= 0:
+            self.flush()
+
+    def flush(self, fsync=False):
+        rows = self.rows
+        self.rows = []
+        self.first = None
+        if rows:
+            if self.rotationDue():
+                self.rotate()
+            try:
+                self.writer.writerows(rows)
+                self.file.flush()
+                if fsync:
+                    os.fsync(self.file.fileno())
+            except (IOError, OSError):
+                self.stats['lost'] += len(rows)
+                logging.exception('logwriter: %s rows lost', len(rows))
+            else:
+                self.stats['written'] += len(rows)
+                self.updateSegment(rows)
+            self.stats['flushes'] += 1
+            if time.time() - self.statsWritten >= STATS_INTERVAL:
+                self.writeStats()
+
+    def updateSegment(self, rows):
+        segment = self.stats['segment']
+        if segment['day'] is None:
+            segment['day'] = time.strftime('%Y-%m-%d')
+        topics = set(segment['topics'])
+        start = segment['start']
+        end = segment['end']
+        for row in rows:
+            ts = row[0]
+            if start is None or ts < start:
+                start = ts
+            if end is None or ts > end:
+                end = ts
+            topics.add(row[-1])
+        segment['start'] = start
+        segment['end'] = end
+        segment['topics'] = sorted(topics)
+        segment['rows'] += len(rows)
+
+    def rotationDue(self):
+        segment = self.stats['segment']
+        if not segment['rows']:
+            return False
+        if self.daily and segment['day'] != time.strftime('%Y-%m-%d'):
+            return True
+        return self.maxSize is not None and self.file.tell() >= self.maxSize
+
+    def rotate(self):
+        self.file.close()
+        name = base = self.path + time.strftime('.%Y%m%d-%H%M%S')
+        suffix = 0
+        while any(os.path.exists(name + ext)
+                  for ext in [''] + list(COMPRESSORS.values())):
+            suffix += 1
+            name = '%s-%s' % (base, suffix)
+        os.rename(self.path, name)
+        segment = self.stats['segment']
+        entry = {
+            "file": os.path.basename(name),
+            "compress": self.compress,
+            "start": segment['start'],
+            "end": segment['end'],
+            "topics": segment['topics'],
+            "rows": segment['rows'],
+        }
+        with open(self.indexPath, 'a') as index:
+            index.write(json.dumps(entry))
+            index.write('\n')
+        self.stats['segment'] = newSegment()
+        self.writeStats()
+        self.open()
+        if self.compress:
+            self.compressor.submit(self.compressSegment, name, self.compress)
+
+    def compressSegment(self, name, compress):
+        try:
+            compressFile(name, compress)
+        except Exception:
+            logging.exception('logwriter: compressing %s failed', name)
+
+    def recompress(self):
+        """Compress segments left uncompressed by a previous run
+        """
+        dirname = os.path.dirname(self.path)
+        for entry in readIndex(self.indexPath):
+            name = os.path.join(dirname, entry['file'])
+            if entry.get('compress') and os.path.exists(name):
+                self.compressor.submit(
+                    self.compressSegment, name, entry['compress'])
+
+    def close(self):
+        self.flush(fsync=True)
+        self.file.close()
+        self.compressor.shutdown(wait=True)
+        self.stats['clean'] = True
+        self.writeStats()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def readIndex(indexPath):
+    try:
+        with open(indexPath, 'r') as index:
+            for line in index:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    except IOError:
+        return
+
+
+def segments(path, start=None, end=None, topic=None):
+    """The files of a rotated log which may contain rows in [start, end]
+
+    start and end are timestamps in the logged format. The live output
+    file is always included last.
+    """
+    dirname = os.path.dirname(path)
+    result = []
+    for entry in readIndex(path + '.index'):
+        if start is not None and entry['end'] < start:
+            continue
+        if end is not None and entry['start'] > end:
+            continue
+        if topic is not None and topic not in entry['topics']:
+            continue
+        name = os.path.join(dirname, entry['file'])
+        if not os.path.exists(name) and entry.get('compress'):
+            # the plain file is gone once the compression finished
+            name += COMPRESSORS[entry['compress']]
+        result.append(name)
+    if os.path.exists(path):
+        result.append(path)
+    return result
+
+
+def openSegment(name):
+    """Open a segment returned by `segments` for reading text
+    """
+    if name.endswith('.gz'):
+        return gzip.open(name, 'rt', newline='')
+    if name.endswith('.zst'):
+        return zstandard.open(name, 'rt', newline='')
+    return open(name, 'r', newline='')
@@ -0,0 +1,87 @@
+"""
+mqttconfig - MQTT client configuration and QoS policy of all modules
+
+The QoS and retain flag of a message depend on its topic:
+
+    actor commands      QoS 2, a lost or duplicated command switches a pump
+    commands, settings  QoS 1, applying them twice does no harm
+    state, forecast     QoS 1 and retained, a new subscriber gets the
+                        current value at once
+    sensor values       QoS 0, the next sample follows in a few seconds
+                        and the broker doesn't queue them for offline
+                        clients
+    hassio discovery    QoS 1 and retained
+
+Subscriptions use QoS 2, the delivery uses the lower QoS of publisher and
+subscription, so the publisher decides.
+"""
+import asyncio
+
+from hbmqtt.mqtt.constants import QOS_0, QOS_1, QOS_2
+
+from topictree import TopicRouter
+
+
+BASE_TOPIC = "/house/heating"
+
+SUBSCRIBE_QOS = QOS_2
+
+# (topic filter, qos, retain), the first matching filter wins, zones use
+# the same topics one level deeper, after the topics of the default zone
+POLICY = [
+    (BASE_TOPIC + '/actors/#', QOS_2, False),
+    (BASE_TOPIC + '/command/#', QOS_1, False),
+    (BASE_TOPIC + '/settings/#', QOS_1, False),
+    (BASE_TOPIC + '/state/#', QOS_1, True),
+    (BASE_TOPIC + '/forecast/#', QOS_1, True),
+    (BASE_TOPIC + '/sensors/#', QOS_0, False),
+    (BASE_TOPIC + '/+/actors/#', QOS_2, False),
+    (BASE_TOPIC + '/+/command/#', QOS_1, False),
+    (BASE_TOPIC + '/+/settings/#', QOS_1, False),
+    (BASE_TOPIC + '/+/state/#', QOS_1, True),
+    (BASE_TOPIC + '/+/sensors/#', QOS_0, False),
+    ('homeassistant/+/+/+/config', QOS_1, True),
+    ('homeassistant/#', QOS_0, False),
+]
+
+DEFAULT_POLICY = (QOS_1, False)
+
+ROUTER = TopicRouter([(f, index) for index, (f, q, r) in enumerate(POLICY)])
+
+# topic -> (qos, retain), the number of topics is small
+policies = {}
+
+
+def clientConfig(cleansession):
+    return {
+        "default_qos": DEFAULT_POLICY[0],
+        # connection.Connection reconnects
+        "auto_reconnect": False,
+        "broker": {
+            "cleansession": cleansession,
+        },
+    }
+
+
+def policy(topic):
+    """The QoS and retain flag of a topic
+    """
+    result = policies.get(topic)
+    if result is None:
+        matches = ROUTER.match(topic)
+        if matches:
+            result = POLICY[min(matches)][1:]
+        else:
+            result = DEFAULT_POLICY
+        policies[topic] = result
+    return result
+
+
+def subscriptions(filters):
+    return [(f, SUBSCRIBE_QOS) for f in filters]
+
+
+@asyncio.coroutine
+def publish(client, topic, payload):
+    qos, retain = policy(topic)
+    yield from client.publish(topic, payload, qos=qos, retain=retain)
@@ -9,59 +9,99 @@ Options:
     --uri=<mqttclient>  MQTT broker URI [default: mqtt://localhost]
     --output=FILE       Logfile [default: /var/log/house/mqtt.log]
     --log=FILE          Logfile [default: /var/log/house/mqttlogger.log]
+    --store=FILE        also write numeric values to a binary store
+    --batch=ROWS        write after this number of rows [default: 500]
+    --latency=SEC       write rows after at most [default: 5]
+    --rotate=RULE       rotate the output by "day", at a size like "50M"
+                        or "none" [default: day]
+    --compress=ALG      compress rotated files with gzip, zstd or none
+                        [default: gzip]
     -v                  log level DEBUG
 """
-import csv
+import time
+import signal
 import asyncio
 import logging
 import docopt
 
-from hbmqtt.client import MQTTClient, ClientException
-from hbmqtt.mqtt.constants import QOS_2
+from hbmqtt.client import MQTTClient
+
+from topictree import TopicRouter
+from mqttconfig import clientConfig, SUBSCRIBE_QOS
+from connection import Connection
+from tsstore import openWriter, formatTimestamp
+from logwriter import BufferedWriter
 
 
 BASE_TOPIC = "/house/heating"
 
 
-CLIENT_CONFIG = {
-    "default_qos": QOS_2,
-    "broker": {
-        "cleansession": False  # don't miss data
-    }
-}
+CLIENT_CONFIG = clientConfig(cleansession=False)  # don't miss data
+
+# creates the MQTT client, replaced by the supervisor
+client_factory = MQTTClient
 
 SUBSCRIPTIONS = [
-    (BASE_TOPIC + '/#', QOS_2),
+    (BASE_TOPIC + '/#', SUBSCRIBE_QOS),
 ]
 
 
 @asyncio.coroutine
 def run(arguments):
-    with open(arguments['--output'], 'a') as outfile:
-        retry = True
-        writer = csv.writer(outfile)
-        while retry:
-            C = MQTTClient(
-                BASE_TOPIC + "/mqttlogger",
-                config=CLIENT_CONFIG,
-            )
-            yield from C.connect(arguments['--uri'])
-            yield from C.subscribe(SUBSCRIPTIONS)
-            try:
-                while True:
-                    message = yield from C.deliver_message()
+    with BufferedWriter(arguments['--output'],
+                        int(arguments['--batch']),
+                        float(arguments['--latency']),
+                        arguments['--rotate'],
+                        arguments['--compress']) as writer, \
+            openWriter(arguments['--store']) as store:
+
+        def logRow(topic, data):
+            if data.startswith('['):
+                # a forecast without issue time, logged with the receive time
+                row = [formatTimestamp(time.time()), data]
+            else:
+                row = data.split(',', 1)
+            row.append(topic)
+            writer.writerow(row)
+
+        def storeRow(topic, data):
+            row = data.split(',', 1)
+            if len(row) == 2:
+                store.appendRow(row[0], row[1], topic)
+
+        router = TopicRouter([(t, logRow) for t, qos in SUBSCRIPTIONS])
+        if store is not None:
+            for t, qos in SUBSCRIPTIONS:
+                router.add(t, storeRow)
+        C = Connection(
+            client_factory,
+            BASE_TOPIC + "/mqttlogger",
+            CLIENT_CONFIG,
+            SUBSCRIPTIONS,
+        )
+        yield from C.connect(arguments['--uri'])
+        try:
+            while True:
+                try:
+                    message = yield from C.deliver_message(
+                        timeout=writer.timeout())
                     packet = message.publish_packet
-                    row = packet.payload.data.decode('utf-8').split(',', 1)
-                    row.append(packet.variable_header.topic_name)
-                    writer.writerow(row)
-                    outfile.flush()
-            except KeyboardInterrupt:
-                retry = False
-            except ClientException as ce:
-                logging.error("Client exception: %s" % ce)
-                yield from C.unsubscribe([s[0] for s in SUBSCRIPTIONS])
-            finally:
-                yield from C.disconnect()
+                    # a retained state sent on subscribe was logged before
+                    if not packet.retain_flag:
+                        router.dispatch(
+                            packet.variable_header.topic_name,
+                            packet.payload.data.decode('utf-8'),
+                        )
+                except asyncio.TimeoutError:
+                    pass
+                writer.flushDue()
+                if store is not None and writer.timeout() is None:
+                    # the log is written, keep the journal of the store in
+                    # step
+                    store.flush()
+        finally:
+            # also on cancel, the with statement closes the log
+            yield from C.disconnect()
 
 
 if __name__ == '__main__':
@@ -74,4 +114,13 @@ if __name__ == '__main__':
         format='%(asctime)s:%(message)s',
         level=level,
     )
-    asyncio.get_event_loop().run_until_complete(run(arguments))
+    loop = asyncio.get_event_loop()
+    main = asyncio.ensure_future(run(arguments))
+    # systemd stops with SIGTERM, like ctrl-c it cancels run so the log is
+    # flushed and closed
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, main.cancel)
+    try:
+        loop.run_until_complete(main)
+    except asyncio.CancelledError:
+        pass
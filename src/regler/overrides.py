@@ -0,0 +1,105 @@
+"""
+overrides - Manual commands which override the control for a while
+
+A command is published to /house/heating/command/<name> (or below the
+base topic of a zone), the payload is the duration, 0 ends the command:
+
+    force_on   heat pump on for N minutes, the guard against short
+               cycling still applies
+    force_off  heat pump off for N minutes
+    boost      nominal temperature raised by boost_offset for N minutes
+    holiday    nominal temperature changed by holiday_offset for N days
+    cancel     ends all commands, without payload
+
+The commands are kept in memory, they end with a restart of regler.
+
+Settings, all optional:
+
+    boost_offset    offset in K [default: 5]
+    holiday_offset  offset in K [default: -5]
+"""
+PUMP_ON = 1
+PUMP_OFF = 0
+
+# command -> (seconds per unit of the duration, max duration)
+COMMANDS = {
+    'force_on': (60, 24 * 60),
+    'force_off': (60, 24 * 60),
+    'boost': (60, 24 * 60),
+    'holiday': (86400, 90),
+}
+
+# commands which end each other
+EXCLUSIVE = {
+    'force_on': 'force_off',
+    'force_off': 'force_on',
+}
+
+
+class Overrides(object):
+
+    __slots__ = ('until',)
+
+    def __init__(self):
+        # command -> end time
+        self.until = {}
+
+    def execute(self, command, data, now):
+        """Start or end a command, raises ValueError for invalid commands
+        """
+        if command == 'cancel':
+            self.until.clear()
+            return
+        if command not in COMMANDS:
+            raise ValueError('unknown command %r' % command)
+        unit, maximum = COMMANDS[command]
+        duration = float(data)
+        if not 0 <= duration <= maximum:
+            raise ValueError('%s: duration %s outside [0 - %s]' % (
+                command, data, maximum))
+        if duration == 0:
+            self.until.pop(command, None)
+            return
+        self.until[command] = now + duration * unit
+        self.until.pop(EXCLUSIVE.get(command), None)
+
+    def active(self, command, now):
+        until = self.until.get(command)
+        if until is None:
+            return False
+        if now >= until:
+            del self.until[command]
+            return False
+        return True
+
+    def expiresAt(self):
+        """Time the next command ends, None without commands
+        """
+        if not self.until:
+            return None
+        return min(self.until.values())
+
+    def offset(self, now, settings):
+        """Change of the nominal temperature
+        """
+        result = 0.0
+        if self.active('boost', now):
+            result += float(settings.get('boost_offset', 5))
+        if self.active('holiday', now):
+            result += float(settings.get('holiday_offset', -5))
+        return result
+
+    def pump(self, now):
+        """The forced pump state, None if the control decides
+        """
+        if self.active('force_off', now):
+            return PUMP_OFF
+        if self.active('force_on', now):
+            return PUMP_ON
+        return None
+
+    def report(self, now):
+        active = [c for c in list(self.until) if self.active(c, now)]
+        if not active:
+            return None
+        return {c: int(self.until[c]) for c in active}
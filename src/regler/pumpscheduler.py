@@ -0,0 +1,83 @@
+"""
+pumpscheduler - Protect the heat pump against short cycling
+
+A transition of the pump is only allowed after the minimum on time or the
+minimum off time has passed and a start is only allowed if there were less
+than the maximum number of starts in the last hour.
+
+Settings, all optional:
+
+    min_on      minimum on time in seconds [default: 300]
+    min_off     minimum off time in seconds [default: 300]
+    max_starts  maximum number of starts per hour [default: 6]
+"""
+from collections import deque
+
+
+PUMP_ON = 1
+PUMP_OFF = 0
+
+HOUR = 3600
+
+
+class PumpScheduler(object):
+
+    def __init__(self):
+        self.lastChange = None
+        self.starts = deque()
+        self.totalStarts = 0
+        self.blocked = 0
+        # time a blocked transition becomes allowed, None if not blocked
+        self.pendingAt = None
+
+    def prune(self, now):
+        while self.starts and (now - self.starts[0]) >= HOUR:
+            self.starts.popleft()
+
+    def nextAllowed(self, pump, now, settings):
+        """The earliest time the pump may leave its current state
+        """
+        self.prune(now)
+        if pump == PUMP_ON:
+            if self.lastChange is None:
+                return now
+            return self.lastChange + float(settings.get('min_on', 300))
+        allowed = now
+        if self.lastChange is not None:
+            allowed = self.lastChange + float(settings.get('min_off', 300))
+        maxStarts = int(settings.get('max_starts', 6))
+        if maxStarts > 0 and len(self.starts) >= maxStarts:
+            allowed = max(allowed, self.starts[-maxStarts] + HOUR)
+        return allowed
+
+    def request(self, pump, wanted, now, settings, force=False):
+        """Returns the new pump state for the wanted state
+
+        force switches the pump off without waiting, e.g. if the sensor
+        values are missing.
+        """
+        if wanted == pump:
+            self.pendingAt = None
+            return pump
+        allowed = self.nextAllowed(pump, now, settings)
+        if now < allowed and not (force and wanted == PUMP_OFF):
+            if self.pendingAt is None:
+                self.blocked += 1
+            self.pendingAt = allowed
+            return pump
+        self.pendingAt = None
+        self.lastChange = now
+        if wanted == PUMP_ON:
+            self.starts.append(now)
+            self.totalStarts += 1
+        return wanted
+
+    def report(self, pump, now, settings):
+        # an absolute time, a countdown would change the state every loop
+        allowed = self.nextAllowed(pump, now, settings)
+        return {
+            "starts_last_hour": len(self.starts),
+            "starts_total": self.totalStarts,
+            "blocked": self.blocked,
+            "next_transition_at": int(allowed) if allowed > now else None,
+        }
@@ -14,8 +14,11 @@ import asyncio
 import logging
 import docopt
 
-from hbmqtt.client import MQTTClient, ClientException
-from hbmqtt.mqtt.constants import QOS_2
+from hbmqtt.client import MQTTClient
+
+from topictree import TopicRouter
+from mqttconfig import clientConfig, SUBSCRIBE_QOS
+from connection import Connection
 
 import RPi.GPIO as GPIO
 
@@ -37,17 +40,10 @@ BASE_TOPIC = "/house/heating"
 ACTOR_BASE_TOPIC = BASE_TOPIC + '/actors'
 
 
-CLIENT_CONFIG = {
-    "default_qos": QOS_2,
-    "broker": {
-        "cleansession": False
-    }
-}
+CLIENT_CONFIG = clientConfig(cleansession=False)
 
-SUBSCRIPTIONS = [
-    (ACTOR_BASE_TOPIC + "/heat_pump", QOS_2),
-    (ACTOR_BASE_TOPIC + "/water_pump", QOS_2),
-]
+# creates the MQTT client, replaced by the supervisor
+client_factory = MQTTClient
 
 
 def pinStateFromMQTTState(state):
@@ -58,6 +54,28 @@ def pinStateFromMQTTState(state):
     return UNKNOWN
 
 
+def switchHeatPump(topic, state):
+    if state == ON:
+        GPIO.output(heatPumpPin, HEAT_PUMP_ON)
+        GPIO.output(waterPumpPin, WATER_PUMP_ON)
+    else:
+        GPIO.output(heatPumpPin, HEAT_PUMP_OFF)
+
+
+def switchWaterPump(topic, state):
+    if state == ON:
+        GPIO.output(waterPumpPin, WATER_PUMP_ON)
+    else:
+        GPIO.output(waterPumpPin, WATER_PUMP_OFF)
+
+
+ROUTER = TopicRouter([
+    (ACTOR_BASE_TOPIC + "/heat_pump", switchHeatPump),
+    (ACTOR_BASE_TOPIC + "/water_pump", switchWaterPump),
+])
+SUBSCRIPTIONS = ROUTER.subscriptions(SUBSCRIBE_QOS)
+
+
 @asyncio.coroutine
 def run(arguments):
     retry = True
@@ -66,42 +84,32 @@ def run(arguments):
     GPIO.setup(waterPumpPin, GPIO.OUT)
     GPIO.output(heatPumpPin, HEAT_PUMP_OFF)
     GPIO.output(waterPumpPin, WATER_PUMP_ON)
-    while retry:
-        C = MQTTClient(
-            BASE_TOPIC + "/pumpswitch",
-            config=CLIENT_CONFIG,
-        )
-        yield from C.connect(arguments['--uri'])
-        yield from C.subscribe(SUBSCRIPTIONS)
-        try:
-            while True:
-                message = yield from C.deliver_message()
-                packet = message.publish_packet
-                topic = packet.variable_header.topic_name
-                state = packet.payload.data.decode('utf-8').split(',')[-1]
-                state = pinStateFromMQTTState(state)
-                if state == UNKNOWN:
-                    continue
-                if topic.endswith('heat_pump'):
-                    if state == ON:
-                        GPIO.output(heatPumpPin, HEAT_PUMP_ON)
-                    else:
-                        GPIO.output(heatPumpPin, HEAT_PUMP_OFF)
-                    if state == ON:
-                        GPIO.output(waterPumpPin, WATER_PUMP_ON)
-                elif topic.endswith('water_pump'):
-                    if state == ON:
-                        GPIO.output(heatPumpPin, WATER_PUMP_ON)
-                    else:
-                        GPIO.output(heatPumpPin, WATER_PUMP_OFF)
-        except KeyboardInterrupt:
-            retry = False
-        except ClientException as e:
-            logging.error("Client exception: %s" % e)
-        except:
-            yield from C.unsubscribe(SUBSCRIPTIONS)
-        finally:
-            yield from C.disconnect()
+    C = Connection(
+        client_factory,
+        BASE_TOPIC + "/pumpswitch",
+        CLIENT_CONFIG,
+        SUBSCRIPTIONS,
+    )
+    yield from C.connect(arguments['--uri'])
+    try:
+        while retry:
+            try:
+                while True:
+                    message = yield from C.deliver_message()
+                    packet = message.publish_packet
+                    topic = packet.variable_header.topic_name
+                    state = packet.payload.data.decode('utf-8')
+                    state = pinStateFromMQTTState(state.split(',')[-1])
+                    if state == UNKNOWN:
+                        continue
+                    ROUTER.dispatch(topic, state)
+            except KeyboardInterrupt:
+                retry = False
+            except Exception as e:
+                logging.exception("Unknown exception: %s" % e)
+    finally:
+        yield from C.disconnect()
+
 
 if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
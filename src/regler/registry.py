@@ -0,0 +1,244 @@
+"""
+registry - Sensors, actors and state of the heating and their entities in
+Home Assistant
+
+regler, sensorreader and hassio take the topics from here, hassio
+generates the discovery configs of all entities. Every zone has the zone
+entities below its base topic, e.g. /house/heating/upstairs/state/nominal,
+the shared entities exist once.
+"""
+import json
+import hashlib
+
+from strategies import STRATEGIES
+
+
+BASE_TOPIC = "/house/heating"
+DISCOVERY_PREFIX = "homeassistant"
+NODE_ID = "house"
+
+DEFAULT_ZONE = 'default'
+
+DEVICE = {
+    "manufacturer": "selbst",
+    "model": "heizung",
+    "name": "Heizung",
+    "identifiers": [
+        "heizung1"
+    ]
+}
+
+TEMPERATURE = {
+    "value_template": "{{ value | float | round(1) }}",
+    "unit_of_measurement": "°C",
+    "device_class": "temperature",
+}
+
+# name -> entity, the topic is below the base topic of the zone, binary
+# sensors are off for the values in "off"
+ZONE_ENTITIES = {
+    "heat_pump": {
+        "component": "binary_sensor",
+        "topic": "/actors/heat_pump",
+        "name": "Wärmepumpe",
+        "unique_id": "house_sensor_heat_pump",
+        "off": ("0",),
+        "config": {},
+    },
+    "flow": {
+        "component": "sensor",
+        "topic": "/sensors/temp/flow",
+        "name": "Wassertemperatur",
+        "unique_id": "house_sensor_flow",
+        "config": TEMPERATURE,
+    },
+    "nominal": {
+        "component": "sensor",
+        "topic": "/state/nominal",
+        "name": "Solltemperatur",
+        "config": TEMPERATURE,
+    },
+    "alarm": {
+        "component": "binary_sensor",
+        "topic": "/state/alarm",
+        "name": "Alarm",
+        "off": ("false",),
+        "config": {
+            "device_class": "problem",
+        },
+    },
+    "alarm_code": {
+        "component": "sensor",
+        "topic": "/state/alarm_code",
+        "name": "Alarmcode",
+        "config": {},
+    },
+    "a": {
+        "component": "number",
+        "topic": "/state/settings/a",
+        "name": "Steigung",
+        "setting": "/settings/a",
+        "config": {"min": -1.0, "max": 0.0, "step": 0.01},
+    },
+    "b": {
+        "component": "number",
+        "topic": "/state/settings/b",
+        "name": "Fusspunkt",
+        "setting": "/settings/b",
+        "config": {
+            "min": 15.0, "max": 45.0, "step": 0.5,
+            "unit_of_measurement": "°C",
+        },
+    },
+    "tolerance": {
+        "component": "number",
+        "topic": "/state/settings/tolerance",
+        "name": "Toleranz",
+        "setting": "/settings/tolerance",
+        "config": {
+            "min": 0.1, "max": 5.0, "step": 0.1,
+            "unit_of_measurement": "K",
+        },
+    },
+    "mode": {
+        "component": "select",
+        "topic": "/state/settings/mode",
+        "name": "Modus",
+        "setting": "/settings/mode",
+        "config": {"options": sorted(STRATEGIES)},
+    },
+}
+
+SHARED_ENTITIES = {
+    "outside_air_temp": {
+        "component": "sensor",
+        "topic": "/sensors/temp/outside_air_temp",
+        "name": "Aussentemperatur",
+        "unique_id": "house_sensor_outside_air",
+        "config": TEMPERATURE,
+    },
+}
+
+# topic filters of the discovery configs and the commands of all entities
+CONFIG_TOPICS = '{}/+/{}/+/config'.format(DISCOVERY_PREFIX, NODE_ID)
+COMMAND_TOPICS = '{}/+/{}/+/set'.format(DISCOVERY_PREFIX, NODE_ID)
+
+# setting -> name of the entity changing it
+SETTINGS = dict(
+    (e['setting'].rsplit('/', 1)[-1], n)
+    for n, e in ZONE_ENTITIES.items() if 'setting' in e)
+
+# topic below the zone base -> name
+SHARED_TOPICS = dict((e['topic'], n) for n, e in SHARED_ENTITIES.items())
+ZONE_TOPICS = dict((e['topic'], n) for n, e in ZONE_ENTITIES.items())
+
+
+def zoneBase(zone=DEFAULT_ZONE):
+    if zone == DEFAULT_ZONE:
+        return BASE_TOPIC
+    return BASE_TOPIC + '/' + zone
+
+
+def entityTopic(name, zone=DEFAULT_ZONE):
+    """The house topic of an entity
+    """
+    if name in SHARED_ENTITIES:
+        return BASE_TOPIC + SHARED_ENTITIES[name]['topic']
+    return zoneBase(zone) + ZONE_ENTITIES[name]['topic']
+
+
+def topicFilters():
+    """Topic filters of the entities of all zones
+    """
+    result = [BASE_TOPIC + e['topic'] for e in SHARED_ENTITIES.values()]
+    for e in ZONE_ENTITIES.values():
+        result.append(BASE_TOPIC + e['topic'])
+        result.append(BASE_TOPIC + '/+' + e['topic'])
+    return result
+
+
+def parseTopic(topic):
+    """The zone and entity name of a house topic, None if unknown
+    """
+    if not topic.startswith(BASE_TOPIC + '/'):
+        return None
+    suffix = topic[len(BASE_TOPIC):]
+    name = SHARED_TOPICS.get(suffix) or ZONE_TOPICS.get(suffix)
+    if name is not None:
+        return DEFAULT_ZONE, name
+    # the other zones are one level deeper
+    zone, _, rest = suffix[1:].partition('/')
+    name = ZONE_TOPICS.get('/' + rest)
+    if name is None or zone == DEFAULT_ZONE:
+        return None
+    return zone, name
+
+
+def entity(name, zone=DEFAULT_ZONE):
+    """The entity with its discovery config
+    """
+    shared = name in SHARED_ENTITIES
+    e = dict(SHARED_ENTITIES[name] if shared else ZONE_ENTITIES[name])
+    objectId = name
+    uniqueId = e.get('unique_id', 'house_' + name)
+    title = 'Heizung ' + e['name']
+    if zone != DEFAULT_ZONE and not shared:
+        objectId = zone + '_' + name
+        uniqueId = 'house_' + objectId
+        title = 'Heizung {} {}'.format(zone, e['name'])
+    e['zone'] = zone
+    e['source'] = entityTopic(name, zone)
+    e['topicBase'] = '{}/{}/{}/{}/'.format(
+        DISCOVERY_PREFIX, e['component'], NODE_ID, objectId)
+    config = {
+        "name": title,
+        "unique_id": uniqueId,
+        "state_topic": e['topicBase'] + 'state',
+    }
+    if 'setting' in e:
+        e['target'] = zoneBase(zone) + e['setting']
+        config['command_topic'] = e['topicBase'] + 'set'
+    if e['component'] == 'binary_sensor':
+        config.update(payload_on='ON', payload_off='OFF')
+    config.update(e['config'])
+    config['device'] = DEVICE
+    e['config'] = config
+    e['payload'] = bytes(json.dumps(config, sort_keys=True), 'utf-8')
+    e['hash'] = configHash(e['payload'])
+    return e
+
+
+def entities(zone=DEFAULT_ZONE):
+    """All entities of a zone, the shared ones belong to the default zone
+    """
+    names = list(ZONE_ENTITIES)
+    if zone == DEFAULT_ZONE:
+        names = list(SHARED_ENTITIES) + names
+    return [entity(name, zone) for name in names]
+
+
+def validate(entity, value):
+    """The value of a setting of the entity, raises ValueError
+    """
+    config = entity['config']
+    if entity['component'] == 'select':
+        if value not in config['options']:
+            raise ValueError('unknown option %r' % value)
+        return value
+    number = float(value)
+    if not config['min'] <= number <= config['max']:
+        raise ValueError('%s outside [%s - %s]' % (
+            value, config['min'], config['max']))
+    return value
+
+
+def validateSetting(name, value):
+    """Validate a setting like an entity would, others are passed through
+    """
+    if name not in SETTINGS:
+        return value
+    return validate(ZONE_ENTITIES[SETTINGS[name]], value)
+
+
+def configHash(payload):
+    return hashlib.sha1(payload).hexdigest()
@@ -12,17 +12,42 @@ Options:
     --log=FILE       Logfile [default: /var/log/house/regler.log]
     -v               log level DEBUG
     --loop-time=INT  calculation loop time [default: 30]
+    --latency=SEC    max delay of a recalculation after a change [default: 1]
+    --heartbeat=SEC  republish unchanged state after [default: 300]
+    --forecast=FILE  outside air temperature forecast, see forecast.py
+    --zones=LIST     additional heating circuits, e.g. upstairs,basement
+
+Every additional zone has its own curve, flow sensor and heat pump below
+/house/heating/<zone>/..., e.g. /house/heating/upstairs/settings/a, and
+its settings in <settings>.<zone>.json. All zones share the outside air
+temperature and are calculated together.
+
+Changed settings are saved once they didn't change for a few seconds.
+The commands below /house/heating/command are described in overrides.py.
 """
+import os
 import copy
 import time
+import functools
 import json
 from datetime import datetime
 import asyncio
 import docopt
 import logging
 
-from hbmqtt.client import MQTTClient, ClientException  # noqa
-from hbmqtt.mqtt.constants import QOS_2  # noqa
+from hbmqtt.client import MQTTClient  # noqa
+
+from topictree import TopicRouter
+from mqttconfig import clientConfig, publish, SUBSCRIBE_QOS
+from connection import Connection
+from settingsstore import SettingsStore
+from strategies import getStrategy
+from pumpscheduler import PumpScheduler
+from filters import SensorFilter
+from freshness import FreshnessMonitor, ALARM_NONE, ALARM_STALE_SENSOR
+from forecast import Forecast, parseForecast, FORECAST_TOPIC
+from registry import DEFAULT_ZONE, zoneBase, entityTopic, validateSetting
+from overrides import Overrides
 
 BASE_TOPIC = "/house/heating"
 SENSOR_BASE_TOPIC = BASE_TOPIC + '/sensors'
@@ -32,29 +57,44 @@ STATE_BASE_TOPIC = BASE_TOPIC + '/state'
 PUMP_ON = 1
 PUMP_OFF = 0
 
-
-CLIENT_CONFIG = {
-    "default_qos": QOS_2,
-    "broker": {
-        "cleansession": True
+# time source of the control logic, replaced by the simulator
+clock = time.time
+
+
+CLIENT_CONFIG = clientConfig(cleansession=True)
+
+# seconds without a change before changed settings are saved, e.g. while
+# a slider is moved
+SETTINGS_DELAY = 5
+
+# creates the MQTT client, replaced by the supervisor
+client_factory = MQTTClient
+
+# topic levels below BASE_TOPIC, not allowed as zone names
+RESERVED = (
+    'sensors', 'actors', 'state', 'settings', 'command', 'forecast', 'regler',
+)
+
+
+def initialState():
+    return {
+        "settings": {
+            "a": -0.2,
+            "b": 28,
+            "tolerance": 1.0,
+            "mode": "auto",
+            "modified": datetime.now().isoformat()
+        },
+        "nominal": None,
+        "heat_pump": PUMP_OFF,
+        "heat_pump_ts": int(time.time()),
+        "alarm": False,
+        "alarm_code": ALARM_NONE,
+        "stale_sensors": [],
+        "strategy": None,
+        "pump_guard": None,
+        "overrides": None,
     }
-}
-
-
-state = {
-    "settings": {
-        "a": -0.2,
-        "b": 28,
-        "tolerance": 1.0,
-        "mode": "auto",
-        "modified": datetime.now().isoformat()
-    },
-    "nominal": None,
-    "heat_pump": PUMP_OFF,
-    "heat_pump_ts": int(time.time()),
-    "alarm": False,
-    "alarm_code": -1,
-}
 
 
 class Value(object):
@@ -65,216 +105,533 @@ class Value(object):
 
     def setValue(self, value):
         self.value = value
-        self.ts = datetime.now().replace(microsecond=0)
+        self.ts = datetime.fromtimestamp(clock()).replace(microsecond=0)
+
+
+class FilteredValue(Value):
+    """A sensor value passed through a SensorFilter
+
+    The value is None until the first sample and after the filter timeout.
+    """
+
+    def __init__(self, topic, value, sensorFilter):
+        self.filter = sensorFilter
+        # time of the last sample, None before the first one
+        self.updated = None
+        super(FilteredValue, self).__init__(topic, value)
+
+    @property
+    def value(self):
+        return self.filter.current(clock())
+
+    def valueFor(self, maxAge):
+        """The value, kept at least until the sample is maxAge seconds old
+        """
+        timeout = self.filter.timeout
+        if timeout is not None:
+            timeout = max(timeout, maxAge)
+        return self.filter.current(clock(), timeout)
+
+    def setValue(self, value):
+        now = clock()
+        self.raw = value
+        if value is not None:
+            self.filter.add(value, now)
+            self.updated = now
+        self.ts = datetime.fromtimestamp(now).replace(microsecond=0)
+
+    def reset(self):
+        self.filter.reset()
+        self.updated = None
 
 
 class PushValue(Value):
+    """A value which is only published if it changed
 
-    def publish(self):
-        return (
-            self.topic,
-            bytes('{}Z,{}'.format(self.ts.isoformat(), self.value), 'utf-8'),
-        )
+    Unchanged values are republished after the heartbeat interval.
+    """
 
+    sent = None
+    sent_at = None
 
-class JSONPushValue(Value):
+    def payload(self):
+        return str(self.value)
 
     def publish(self):
         return (
             self.topic,
-            bytes('{}Z,{}'.format(
-                    self.ts.isoformat(),
-                    json.dumps(self.value)
-                ), 'utf-8'),
+            bytes('{}Z,{}'.format(self.ts.isoformat(), self.payload()),
+                  'utf-8'),
         )
 
+    def changed(self, heartbeat=None):
+        if self.sent is None or self.payload() != self.sent:
+            return True
+        return heartbeat is not None and (
+            time.time() - self.sent_at) >= heartbeat
+
+    def markSent(self):
+        self.sent = self.payload()
+        self.sent_at = time.time()
+
+
+class JSONPushValue(PushValue):
+    """Publishes the value as JSON and optionally each field on its own
+
+    With a fields topic every leaf of the value is also published below
+    this topic, e.g. `<fieldsTopic>/settings/a`, so consumers don't have
+    to parse the whole document.
+    """
+
+    def __init__(self, topic, value, fieldsTopic=None):
+        super(JSONPushValue, self).__init__(topic, value)
+        self.fieldsTopic = fieldsTopic
+        self.sentFields = {}
+
+    def payload(self):
+        return json.dumps(self.value)
+
+    def fields(self, value=None, prefix=''):
+        if value is None:
+            value = self.value
+        for name, v in value.items():
+            if isinstance(v, dict):
+                yield from self.fields(v, prefix + name + '/')
+            elif isinstance(v, str):
+                yield prefix + name, v
+            else:
+                yield prefix + name, json.dumps(v)
+
+    def publishFields(self, heartbeat=None):
+        if self.fieldsTopic is None:
+            return []
+        now = time.time()
+        result = []
+        for name, v in self.fields():
+            sent = self.sentFields.get(name)
+            if (sent is not None and sent[0] == v and (
+                    heartbeat is None or (now - sent[1]) < heartbeat)):
+                continue
+            self.sentFields[name] = (v, now)
+            result.append((
+                self.fieldsTopic + '/' + name,
+                bytes('{}Z,{}'.format(self.ts.isoformat(), v), 'utf-8'),
+            ))
+        return result
+
+
+class Zone(object):
+    """One heating circuit with its own curve, flow sensor and heat pump
+
+    The default zone uses the topics below BASE_TOPIC, every other zone
+    the topics below BASE_TOPIC/<name>.
+    """
+
+    __slots__ = (
+        'name', 'base', 'state', 'sensors', 'push_state', 'scheduler',
+        'freshness', 'strategies', 'no_calc', 'store', 'old_settings',
+        'overrides', 'changed',
+    )
 
-sensors = {
-    "flow": Value(
-        SENSOR_BASE_TOPIC + "/temp/flow",
-        None),
-    "outside_air_temp": Value(
-        SENSOR_BASE_TOPIC + "/temp/outside_air_temp",
-        None),
-}
-push_state = {
-    'heat_pump': PushValue(
-        ACTOR_BASE_TOPIC + "/heat_pump",
-        state['heat_pump']),
-    "state": JSONPushValue(
-        STATE_BASE_TOPIC + "/state",
-        state),
-}
+    def __init__(self, name, outsideAirTemp):
+        if name != DEFAULT_ZONE and (
+                name in RESERVED or not name.replace('_', '').isalnum()):
+            raise ValueError('invalid zone name %r' % name)
+        self.name = name
+        self.base = zoneBase(name)
+        self.state = initialState()
+        # the sensors are read every 10s, a DS18B20 reads 85.0 after a
+        # power glitch
+        self.sensors = {
+            "flow": FilteredValue(
+                entityTopic('flow', name),
+                None,
+                SensorFilter(window=3, maxRate=0.2, timeout=120)),
+            "outside_air_temp": outsideAirTemp,
+        }
+        self.push_state = {
+            'heat_pump': PushValue(
+                entityTopic('heat_pump', name),
+                self.state['heat_pump']),
+            "state": JSONPushValue(
+                self.base + "/state/state",
+                self.state,
+                self.base + "/state"),
+        }
+        self.store = None
+        self.old_settings = copy.deepcopy(self.state['settings'])
+        # time of the last unsaved change of the settings
+        self.changed = None
+        self.reset()
+
+    def reset(self):
+        # minimum on/off times and start budget of the heat pump
+        self.scheduler = PumpScheduler()
+        # age of the sensor values and fail-safe mode
+        self.freshness = FreshnessMonitor()
+        self.strategies = {}
+        # commands
+        self.overrides = Overrides()
+        self.no_calc = False
+        # the outside air temperature is shared
+        self.sensors['flow'].reset()
+
+
+# shared by all zones
+outside_air_temp = FilteredValue(
+    entityTopic('outside_air_temp'),
+    None,
+    SensorFilter(method='ema', alpha=0.2, maxRate=0.05, timeout=600))
+
+zones = {DEFAULT_ZONE: Zone(DEFAULT_ZONE, outside_air_temp)}
+
+# the default zone
+state = zones[DEFAULT_ZONE].state
+sensors = zones[DEFAULT_ZONE].sensors
+push_state = zones[DEFAULT_ZONE].push_state
+
+
+def earliest(times):
+    times = [t for t in times if t is not None]
+    if not times:
+        return None
+    return min(times)
 
 
 @asyncio.coroutine
 def run(arguments):
-    global SUBSCRIPTIONS
-    readSettings()
+    global ROUTER, dirty, forecast_file
+    for name in (arguments['--zones'] or '').split(','):
+        if name.strip():
+            addZone(name.strip())
+    for zone in zones.values():
+        readSettings(zone)
+    forecast_file = arguments['--forecast']
     loop_time = int(arguments['--loop-time'])
-    retry = True
-    while retry:
-        C = MQTTClient(
-            BASE_TOPIC + "/regler",
-            config=CLIENT_CONFIG,
-        )
-        yield from C.connect(arguments['--uri'])
-        yield from C.subscribe([(s[0], QOS_2) for s in SUBSCRIPTIONS])
-        try:
-            push_state['heat_pump'].setValue(state['heat_pump'])
-            yield from C.publish(*push_state['heat_pump'].publish())
-            yield from C.publish(*push_state['state'].publish())
-            start = time.time()
-            while True:
-                packet = None
-                wait_time = max(loop_time - (time.time() - start), 0)
-                logging.debug("wait_time= %s", wait_time)
-                try:
-                    message = yield from C.deliver_message(timeout=wait_time)
-                    packet = message.publish_packet
-                except asyncio.TimeoutError:
-                    pass
-                if packet:
-                    executePacket(packet)
-                if (time.time() - start) > loop_time:
-                    start = time.time()
-                    calculateNominal()
-                    calulateHeatPumpState()
-                    push_state['heat_pump'].setValue(state['heat_pump'])
-                    yield from C.publish(*push_state['heat_pump'].publish())
-                    yield from C.publish(*push_state['state'].publish())
-        except KeyboardInterrupt:
-            retry = False
-        except ClientException as e:
-            logging.exception("Client exception: %s" % e)
-        except Exception as e:
-            logging.exception("Unknown exception: %s" % e)
-        finally:
-            yield from C.unsubscribe([s[0] for s in SUBSCRIPTIONS])
-            yield from C.disconnect()
-        if retry:
-            print("retry")
-
-
-def pushData(C):
-    global push_state, state
-    push_state['heat_pump'].setValue(state['heat_pump'])
-    yield from C.publish(*push_state['heat_pump'].publish())
-    yield from C.publish(*push_state['state'].publish())
-
-
-no_calc = False
-
-
-def calculateNominal():
-    global no_calc, state, sensors
-    outside_air_temp = sensors['outside_air_temp']
-    oat = outside_air_temp.value
+    latency = float(arguments['--latency'])
+    heartbeat = float(arguments['--heartbeat'])
+    C = Connection(
+        client_factory,
+        BASE_TOPIC + "/regler",
+        CLIENT_CONFIG,
+        ROUTER.subscriptions(SUBSCRIBE_QOS),
+        # publish everything after a (re)connect
+        onConnect=lambda C: pushData(C, 0),
+    )
+    yield from C.connect(arguments['--uri'])
+    start = time.time()
+    try:
+        retry = True
+        while retry:
+            try:
+                while True:
+                    packet = None
+                    # the periodic tick is only a watchdog, changes are
+                    # calculated as soon as the debounce latency has passed
+                    deadline = start + loop_time
+                    if dirty is not None:
+                        deadline = min(deadline, dirty + latency)
+                    pending = earliest(
+                        zone.scheduler.pendingAt for zone in zones.values())
+                    if pending is not None:
+                        # a blocked transition, recalculate when it is allowed
+                        deadline = min(deadline, pending)
+                    expires = earliest(
+                        zone.freshness.expiresAt(
+                            zone.sensors, zone.state['settings'])
+                        for zone in zones.values())
+                    if expires is not None:
+                        # detect a stale sensor as soon as it gets stale
+                        deadline = min(deadline, expires)
+                    ends = earliest(
+                        zone.overrides.expiresAt() for zone in zones.values())
+                    if ends is not None:
+                        deadline = min(deadline, ends)
+                    changed = earliest(
+                        zone.changed for zone in zones.values())
+                    if changed is not None:
+                        deadline = min(deadline, changed + SETTINGS_DELAY)
+                    wait_time = max(deadline - time.time(), 0)
+                    logging.debug("wait_time= %s", wait_time)
+                    try:
+                        message = yield from C.deliver_message(
+                            timeout=wait_time)
+                        packet = message.publish_packet
+                    except asyncio.TimeoutError:
+                        pass
+                    if packet:
+                        executePacket(packet)
+                    now = time.time()
+                    storeChangedSettings(now - SETTINGS_DELAY)
+                    if ((now - start) > loop_time
+                            or (dirty is not None and (now - dirty) >= latency)
+                            or (pending is not None and now >= pending)
+                            or (expires is not None and now >= expires)
+                            or (ends is not None and now >= ends)):
+                        start = now
+                        dirty = None
+                        calculateZones()
+                        # buffered while the broker is away
+                        yield from pushData(C, heartbeat)
+            except KeyboardInterrupt:
+                retry = False
+            except Exception as e:
+                logging.exception("Unknown exception: %s" % e)
+    finally:
+        storeChangedSettings()
+        yield from C.disconnect()
+
+
+def pushData(C, heartbeat=None):
+    for zone in zones.values():
+        push_state = zone.push_state
+        push_state['heat_pump'].setValue(zone.state['heat_pump'])
+        push_state['state'].setValue(zone.state)
+        for value in push_state.values():
+            if value.changed(heartbeat):
+                yield from publish(C, *value.publish())
+                value.markSent()
+        for topic, payload in push_state['state'].publishFields(heartbeat):
+            yield from publish(C, topic, payload)
+
+
+# time of the first change since the last calculation, None if up to date
+dirty = None
+
+# outside air temperature forecast, from MQTT or the --forecast file
+forecast = Forecast()
+forecast_file = None
+
+
+def markDirty():
+    global dirty
+    if dirty is None:
+        dirty = time.time()
+
+
+def calculateNominal(zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    state = zone.state
+    oat = zone.sensors['outside_air_temp'].value
     if oat is None:
-        print('no oat')
-        if not no_calc:
+        logging.warning('no outside air temperature in zone %s', zone.name)
+        if not zone.no_calc:
             logging.error('No outside air temperature')
-            no_calc = True
+            zone.no_calc = True
         return False
-    no_calc = False
+    zone.no_calc = False
     settings = state['settings']
+    if forecast_file:
+        forecast.updateFromFile(forecast_file)
+    # the house lags behind, heat for the coming outside air temperature
+    oat = forecast.effective(oat, clock(), settings)
     a = float(settings['a'])
     b = float(settings['b'])
     n = a * oat + b
+    # boost and holiday
+    n += zone.overrides.offset(clock(), settings)
+    if 'knee' in settings and 'a2' in settings:
+        # piecewise curve, a2 is the additional slope below the knee
+        knee = float(settings['knee'])
+        if oat < knee:
+            n += float(settings['a2']) * (oat - knee)
     state['nominal'] = n
     return True
 
 
-def calulateHeatPumpState():
-    global state, sensors
-    oat = sensors['outside_air_temp'].value
-    current = sensors['flow'].value
-    tolerance = float(state['settings']['tolerance'])
+def calulateHeatPumpState(zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    state = zone.state
+    sensors = zone.sensors
+    settings = state['settings']
+    # a quiet sensor is handled by the fail-safe mode once it is stale, the
+    # filter must not drop its value before and stop the pump without alarm
+    maxAge = float(settings.get('stale_after', 300))
+    oat = sensors['outside_air_temp'].valueFor(maxAge)
+    current = sensors['flow'].valueFor(maxAge)
     nominal = state['nominal']
     pump = state['heat_pump']
-    old_pump = pump
-    pump_ts = state['heat_pump_ts']
-    if nominal is None or current is None or oat is None:
+    now = clock()
+    strategy = getStrategy(settings.get('mode', 'auto'), zone.strategies)
+    force = False
+    stale = zone.freshness.check(sensors, now, settings)
+    state['stale_sensors'] = stale
+    state['alarm'] = bool(stale)
+    state['alarm_code'] = ALARM_STALE_SENSOR if stale else ALARM_NONE
+    if stale:
+        wanted = zone.freshness.failsafe(now, settings)
+        force = wanted == PUMP_OFF
+    elif nominal is None or current is None or oat is None:
         # no valid values
-        pump = PUMP_OFF
+        wanted = PUMP_OFF
+        force = True
     elif oat > 18.0:
         # never heat above this outside temp
-        pump = PUMP_OFF
-    elif pump == PUMP_ON and current > (nominal + tolerance):
-        pump = PUMP_OFF
-    elif pump == PUMP_OFF and current < (nominal - tolerance):
-        pump = PUMP_ON
-    now = time.time()
-    if old_pump != pump and (pump_ts is None or (now - pump_ts) > 60):
-        state['heat_pump'] = pump
+        wanted = PUMP_OFF
+    else:
+        wanted = strategy.decide(
+            pump, current, nominal, oat, settings, now)
+    forced = zone.overrides.pump(now)
+    if forced is not None:
+        # a command overrides the control, the guard still applies
+        wanted = forced
+        force = forced == PUMP_OFF
+    state['overrides'] = zone.overrides.report(now)
+    state['strategy'] = strategy.report()
+    scheduler = zone.scheduler
+    new_pump = scheduler.request(pump, wanted, now, settings, force)
+    if new_pump != pump:
+        state['heat_pump'] = new_pump
         state['heat_pump_ts'] = int(now)
+    state['pump_guard'] = scheduler.report(new_pump, now, settings)
+
+
+def calculateZones():
+    """Calculate all zones in one batch
+    """
+    for zone in zones.values():
+        calculateNominal(zone)
+        calulateHeatPumpState(zone)
 
 
 def executePacket(packet):
-    global SUBSCRIPTIONS
+    global ROUTER
     topic = packet.variable_header.topic_name
-    for t, f in SUBSCRIPTIONS:
-        if topic.startswith(t.strip('#')):
-            data = packet.payload.data.decode('utf-8')
-            f(topic, data)
-            break
+    data = packet.payload.data.decode('utf-8')
+    ROUTER.dispatch(topic, data)
 
 
-def updateTemp(topic, data):
-    global sensors
+def updateTemp(topic, data, zone=None):
+    sensors = (zone or zones[DEFAULT_ZONE]).sensors
     sensorName = topic.rsplit('/', 1)[-1]
     if sensorName in sensors:
         data = data.split(',')
-        sensors[sensorName].setValue(float(data[-1]))
+        sensor = sensors[sensorName]
+        old = sensor.value
+        sensor.setValue(float(data[-1]))
+        if sensor.value != old:
+            markDirty()
 
 
-def updateSettings(topic, data):
-    global state
+def updateSettings(topic, data, zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    settings = zone.state['settings']
     settingName = topic.rsplit('/', 1)[-1]
-    state['settings'][settingName] = data
-    storeSettings()
+    try:
+        data = validateSetting(settingName, data)
+    except ValueError as e:
+        logging.warning('[%s] invalid value: %s', topic, e)
+        return
+    if settings.get(settingName) != data:
+        markDirty()
+    settings[settingName] = data
+    # saved by storeChangedSettings once the changes stop
+    zone.changed = time.time()
+
+
+def updateForecast(topic, data):
+    try:
+        issued, points = parseForecast(data, clock())
+        forecast.update(points, issued)
+    except (ValueError, TypeError) as e:
+        logging.warning('invalid forecast on %s: %s', topic, e)
+        return
+    markDirty()
+
+
+def executeCommand(topic, data, zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    command = topic.rsplit('/', 1)[-1]
+    try:
+        zone.overrides.execute(command, data, clock())
+    except ValueError as e:
+        logging.warning('[%s] invalid command: %s', zone.name, e)
+        return
+    logging.info('[%s] command %s %s', zone.name, command, data)
+    markDirty()
+
+
+# subscriptions of every zone, below the base topic of the zone
+ZONE_SUBSCRIPTIONS = [
+    ('/sensors/temp/#', updateTemp),
+    ('/settings/#', updateSettings),
+    ('/command/#', executeCommand),
+]
 
+SUBSCRIPTIONS = [
+    (BASE_TOPIC + suffix, handler) for suffix, handler in ZONE_SUBSCRIPTIONS
+] + [
+    (FORECAST_TOPIC, updateForecast),
+]
+ROUTER = TopicRouter(SUBSCRIPTIONS)
 
-def executeCommand(topic, data):
-    pass
 
+def addZone(name):
+    # run is started again by the supervisor, keep the zone and its routes
+    if name == DEFAULT_ZONE:
+        raise ValueError('invalid zone name %r' % name)
+    if name in zones:
+        return zones[name]
+    zone = Zone(name, outside_air_temp)
+    zones[name] = zone
+    for suffix, handler in ZONE_SUBSCRIPTIONS:
+        ROUTER.add(zone.base + suffix, functools.partial(handler, zone=zone))
+    return zone
 
-SUBSCRIPTIONS = [
-    ('/house/heating/sensors/temp/#', updateTemp),
-    ('/house/heating/settings/#', updateSettings),
-    ('/house/heating/command/#', executeCommand),
-]
 
+def settingsPath(zone):
+    path = arguments['--settings']
+    if zone.name == DEFAULT_ZONE:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}.{}{}'.format(root, zone.name, ext)
 
-old_settings = copy.deepcopy(state['settings'])
 
+def settingsStore(zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    if zone.store is None:
+        zone.store = SettingsStore(settingsPath(zone))
+    return zone.store
 
-def storeSettings():
-    global old_settings, state, arguments
-    settings = state['settings']
-    if old_settings != settings:
+
+def storeSettings(zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    settings = zone.state['settings']
+    if zone.old_settings != settings:
         settings["modified"] = datetime.now().isoformat()
-        old_settings = copy.deepcopy(settings)
-        with open(arguments['--settings'], 'a') as s:
-            s.write(json.dumps(settings))
-            s.write('\n')
-
-
-def readSettings():
-    global old_settings, state, arguments
-    lastLine = None
-    with open(arguments['--settings'], 'r') as s:
-        while True:
-            line = s.readline()
-            if not line:
-                break
-            if not line.startswith('#'):
-                lastLine = line.strip()
-    if lastLine:
-        s = json.loads(lastLine)
-        state['settings'] = s
-        old_settings = copy.deepcopy(state['settings'])
-    logging.info('readSettings: %s', state['settings'])
+        zone.old_settings = copy.deepcopy(settings)
+        settingsStore(zone).append(settings)
+
+
+def storeChangedSettings(before=None):
+    """Save the settings changed before a time, all without time
+    """
+    for zone in zones.values():
+        if zone.changed is not None and (
+                before is None or zone.changed <= before):
+            zone.changed = None
+            storeSettings(zone)
+
+
+def readSettings(zone=None):
+    zone = zone or zones[DEFAULT_ZONE]
+    settings = settingsStore(zone).latest()
+    if settings:
+        defaults = zone.state['settings']
+        for name, value in list(settings.items()):
+            try:
+                validateSetting(name, value)
+            except (ValueError, TypeError) as e:
+                # saved before the settings were validated
+                logging.warning('invalid setting %s: %s', name, e)
+                if name in defaults:
+                    settings[name] = defaults[name]
+                else:
+                    del settings[name]
+        zone.state['settings'] = settings
+        zone.old_settings = copy.deepcopy(settings)
+    logging.info('readSettings %s: %s', zone.name, zone.state['settings'])
+
 
 arguments = None
 
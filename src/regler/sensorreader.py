@@ -12,94 +12,140 @@ Options:
     -v                  log level DEBUG
 """
 import os
-import time
 import asyncio
 import logging
 import docopt
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Force W1ThermSensor package to not load kernel modules
 os.environ["W1THERMSENSOR_NO_KERNEL_MODULE"] = "1"
 from w1thermsensor import W1ThermSensor, NoSensorFoundError  # noqa
 
-from hbmqtt.client import MQTTClient, ClientException  # noqa
-from hbmqtt.mqtt.constants import QOS_2  # noqa
+from hbmqtt.client import MQTTClient  # noqa
+
+from mqttconfig import clientConfig, publish
+from connection import Connection
+from registry import entityTopic
 
 
 BASE_TOPIC = "/house/heating"
-SENSOR_BASE_TOPIC = BASE_TOPIC + '/sensors'
 
 
-CLIENT_CONFIG = {
-    "default_qos": QOS_2,
-    "broker": {
-        "cleansession": False  # don't miss data
-    }
-}
+CLIENT_CONFIG = clientConfig(cleansession=False)  # don't miss data
+
+# creates the MQTT client, replaced by the supervisor
+client_factory = MQTTClient
 
 SENSORS = {
     "flow_temp": {
         "id": '0416c19d01ff',
-        "topic": SENSOR_BASE_TOPIC + "/temp/flow",
+        "topic": entityTopic('flow'),
         "min": -10.0,
         "max": 50.0,
     },
     "outside_air_temp": {
         "id": '03168514c9ff',
-        "topic": SENSOR_BASE_TOPIC + "/temp/outside_air_temp",
+        "topic": entityTopic('outside_air_temp'),
         "min": -30.0,
         "max": 50.0,
     },
 }
 
 
+def readSensor(name, s):
+    """Read one sensor, blocks for the duration of the conversion
+
+    Runs in the executor so the conversions of all sensors overlap.
+    """
+    if 'sensor_client' not in s:
+        try:
+            s['sensor_client'] = W1ThermSensor(
+                W1ThermSensor.THERM_SENSOR_DS18B20,
+                s['id'],
+            )
+            logging.info('[%s] sonsor found' % name)
+        except NoSensorFoundError:
+            logging.error('[%s] sonsor not found' % name)
+            return None
+    return s['sensor_client'].get_temperature()
+
+
+@asyncio.coroutine
+def sampleSensors(loop, executor):
+    names = list(SENSORS.keys())
+    temps = yield from asyncio.gather(
+        *[loop.run_in_executor(executor, readSensor, name, SENSORS[name])
+          for name in names],
+        return_exceptions=True
+    )
+    samples = []
+    for name, t in zip(names, temps):
+        s = SENSORS[name]
+        if isinstance(t, Exception):
+            logging.error("[%s] read failed: %s" % (name, t))
+            continue
+        if t is None:
+            continue
+        if t < s['min'] or t > s['max']:
+            logging.warning("[%s] temp %s outside [%s - %s]" % (
+                name, t, s['min'], s['max']
+            ))
+            continue
+        samples.append((s['topic'], t))
+    return samples
+
+
+@asyncio.coroutine
+def publishSamples(C, samples):
+    now = datetime.now().replace(microsecond=0)
+    yield from asyncio.gather(*[
+        publish(
+            C,
+            topic,
+            bytes('{}Z,{}'.format(now.isoformat(), t), 'utf-8'),
+        )
+        for topic, t in samples
+    ])
+
+
 @asyncio.coroutine
 def run(arguments):
     poll_interval = int(arguments['--interval'])
-    # connect to the MQTT brocker
-    C = MQTTClient(
+    loop = asyncio.get_event_loop()
+    # one thread per sensor, all conversions run at the same time
+    executor = ThreadPoolExecutor(max_workers=max(1, len(SENSORS)))
+    # connect to the MQTT brocker, samples are buffered while it is away
+    C = Connection(
+        client_factory,
         BASE_TOPIC + "/sensorreader",
-        config=CLIENT_CONFIG,
+        CLIENT_CONFIG,
     )
     yield from C.connect(arguments['--uri'])
     try:
-        for sensor in W1ThermSensor.get_available_sensors():
-            logging.debug("Sensor: %s", sensor.id)
-        while True:
-            start = time.time()
-            for name, s in SENSORS.items():
-                if 'sensor_client' not in s:
-                    try:
-                        s['sensor_client'] = W1ThermSensor(
-                            W1ThermSensor.THERM_SENSOR_DS18B20,
-                            s['id'],
-                        )
-                        logging.info('[%s] sonsor found' % name)
-                    except NoSensorFoundError:
-                        logging.error('[%s] sonsor not found' % name)
-                        continue
-                t = s['sensor_client'].get_temperature()
-                if t < s['min'] or t > s['max']:
-                    logging.warning("[%s] temp %s outside [%s - %s]" % (
-                        name, t, s['min'], s['max']
-                    ))
-                    continue
-                now = datetime.now().replace(microsecond=0)
-                data = '{}Z,{}'.format(now.isoformat(), t)
-                yield from C.publish(
-                    s['topic'],
-                    bytes(data, 'utf-8'),
-                    qos=QOS_2,
-                )
-            end = time.time()
-            time.sleep(max(0, poll_interval - (end - start)))
-    except KeyboardInterrupt:
-        pass
-    except:
-        logging.exception("")
+        retry = True
+        while retry:
+            try:
+                for sensor in W1ThermSensor.get_available_sensors():
+                    logging.debug("Sensor: %s", sensor.id)
+                while True:
+                    start = loop.time()
+                    samples = yield from sampleSensors(loop, executor)
+                    yield from publishSamples(C, samples)
+                    end = loop.time()
+                    logging.debug("cycle time %.3fs", end - start)
+                    yield from asyncio.sleep(
+                        max(0, poll_interval - (end - start)))
+            except KeyboardInterrupt:
+                retry = False
+            except Exception:
+                logging.exception("")
+                yield from asyncio.sleep(poll_interval)
     finally:
+        executor.shutdown(wait=False)
         yield from C.disconnect()
 
+
 if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
     level = logging.INFO
@@ -0,0 +1,148 @@
+"""
+settingsstore - Journal of the regler settings
+Usage:
+    settingsstore [-h | --help]
+    settingsstore latest [--settings=FILE]
+    settingsstore at <ts> [--settings=FILE]
+    settingsstore history [--settings=FILE] [--from=TS] [--to=TS]
+    settingsstore compact [--settings=FILE]
+
+Options:
+    -h --help           Show this screen.
+    --settings=FILE     Settings file in JSON format
+                        [default: /etc/house/settings.json]
+    --from=TS           first modification time, e.g. 2018-01-01T00:00
+    --to=TS             last modification time
+
+The settings file is an append only journal with one JSON snapshot per
+line, lines starting with '#' are comments. The current settings are the
+last line which is read by seeking from the end of the file, so loading
+doesn't depend on the length of the history.
+
+When the journal grows beyond the compaction size all but the last snapshot
+are moved to `<settings>.history`. The history and the journal together
+keep every change and can be queried by the `modified` timestamp.
+"""
+import os
+import json
+import docopt
+
+
+COMPACT_SIZE = 64 * 1024
+BLOCK_SIZE = 4096
+
+
+class SettingsStore(object):
+
+    def __init__(self, path, compactSize=COMPACT_SIZE):
+        self.path = path
+        self.historyPath = path + '.history'
+        self.compactSize = compactSize
+
+    def latest(self):
+        """The last snapshot or None if there is none
+        """
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return None
+        with f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            tail = b''
+            while pos > 0:
+                size = min(BLOCK_SIZE, pos)
+                pos -= size
+                f.seek(pos)
+                tail = f.read(size) + tail
+                lines = tail.split(b'\n')
+                # the first line may be incomplete unless we are at the start
+                complete = lines if pos == 0 else lines[1:]
+                for line in reversed(complete):
+                    line = line.strip()
+                    if line and not line.startswith(b'#'):
+                        return json.loads(line.decode('utf-8'))
+                tail = lines[0]
+        return None
+
+    def append(self, settings):
+        with open(self.path, 'a') as s:
+            s.write(json.dumps(settings))
+            s.write('\n')
+            size = s.tell()
+        if size > self.compactSize:
+            self.compact()
+
+    def compact(self):
+        """Move all but the last snapshot to the history file
+        """
+        comments = []
+        snapshots = []
+        with open(self.path, 'r') as s:
+            for line in s:
+                line = line.strip()
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    comments.append(line)
+                else:
+                    snapshots.append(line)
+        if len(snapshots) < 2:
+            return
+        with open(self.historyPath, 'a') as h:
+            for line in snapshots[:-1]:
+                h.write(line)
+                h.write('\n')
+            h.flush()
+            os.fsync(h.fileno())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as s:
+            for line in comments + snapshots[-1:]:
+                s.write(line)
+                s.write('\n')
+            s.flush()
+            os.fsync(s.fileno())
+        os.replace(tmp, self.path)
+
+    def history(self, start=None, end=None):
+        """All snapshots modified in [start, end] in journal order
+        """
+        for path in (self.historyPath, self.path):
+            try:
+                f = open(path, 'r')
+            except IOError:
+                continue
+            with f:
+                for line in f:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    settings = json.loads(line)
+                    modified = settings.get('modified', '')
+                    if start is not None and modified < start:
+                        continue
+                    if end is not None and modified > end:
+                        continue
+                    yield settings
+
+    def at(self, ts):
+        """The settings which were active at the timestamp
+        """
+        result = None
+        for settings in self.history(end=ts):
+            result = settings
+        return result
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    store = SettingsStore(arguments['--settings'])
+    if arguments['latest']:
+        print(json.dumps(store.latest()))
+    elif arguments['at']:
+        print(json.dumps(store.at(arguments['<ts>'])))
+    elif arguments['history']:
+        for settings in store.history(arguments['--from'], arguments['--to']):
+            print(json.dumps(settings))
+    elif arguments['compact']:
+        store.compact()
@@ -0,0 +1,276 @@
+"""
+simulator - Replay logged sensor data through the regler control logic
+Usage:
+    simulator [-h | --help]
+    simulator [options]
+
+Options:
+    -h --help           Show this screen.
+    --log=FILE          log written by mqttlogger
+                        [default: /var/log/house/mqtt.log]
+    --settings=FILE     settings used for values without candidates
+                        [default: /etc/house/settings.json]
+    --from=TS           first timestamp, e.g. 2019-11-01T00:00:00Z
+    --to=TS             last timestamp
+    --a=LIST            candidates for a, e.g. -0.2,-0.15,-0.1
+    --b=LIST            candidates for b, e.g. 28:32:0.5 (start:stop:step)
+    --tolerance=LIST    candidates for the tolerance
+    --step=SEC          interval of the control loop [default: 30]
+    --plant=MODEL       "model" simulates the flow temperature with a
+                        model fitted to the log, "replay" uses the logged
+                        flow temperature [default: model]
+    --workers=N         number of processes, defaults to the CPU count
+
+The calculation uses the functions of regler on a virtual clock. Prints one
+CSV row per parameter combination, sorted by the number of pump starts.
+"""
+import os
+import csv
+import sys
+import itertools
+import multiprocessing
+import docopt
+
+import numpy as np
+
+import regler
+from history import loadSeries
+from forecast import Forecast
+from settingsstore import SettingsStore
+from tsstore import parseTimestamp
+
+
+OAT_TOPIC = regler.SENSOR_BASE_TOPIC + "/temp/outside_air_temp"
+FLOW_TOPIC = regler.SENSOR_BASE_TOPIC + "/temp/flow"
+PUMP_TOPIC = regler.ACTOR_BASE_TOPIC + "/heat_pump"
+
+# samples older than this are treated as missing
+MAX_AGE = 600
+
+# used if the log doesn't contain enough data to fit the plant
+DEFAULT_PLANT = {
+    "loss": 1.0 / 3600,   # 1/s, cooling towards the outside air
+    "gain": 10.0 / 3600,  # K/s, heating while the pump is on
+}
+
+METRICS = [
+    'a', 'b', 'tolerance', 'starts', 'starts_per_day', 'on_hours',
+    'band_violations', 'lift_kh',
+]
+
+
+class VirtualClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def resample(ts, values, grid, maxAge=MAX_AGE):
+    """The last sample at or before each grid point, nan if too old
+    """
+    result = np.full(len(grid), np.nan)
+    if not len(ts):
+        return result
+    index = np.searchsorted(ts, grid, side='right') - 1
+    valid = index >= 0
+    index = np.maximum(index, 0)
+    if maxAge is not None:
+        valid &= (grid - ts[index]) <= maxAge
+    result[valid] = values[index[valid]]
+    return result
+
+
+def loadData(log, start=None, end=None, step=30):
+    oat = loadSeries(log, OAT_TOPIC, start, end)
+    flow = loadSeries(log, FLOW_TOPIC, start, end)
+    pump = loadSeries(log, PUMP_TOPIC, start, end)
+    if not len(oat[0]) or not len(flow[0]):
+        raise ValueError('no sensor data in %s' % log)
+    first = max(oat[0][0], flow[0][0])
+    last = min(oat[0][-1], flow[0][-1])
+    grid = np.arange(first, last, step, dtype=np.int64)
+    return {
+        "step": step,
+        "ts": grid,
+        "oat": resample(oat[0], oat[1], grid),
+        "flow": resample(flow[0], flow[1], grid),
+        # the pump is only published on changes
+        "pump": resample(pump[0], pump[1], grid, None),
+    }
+
+
+def fitPlant(data):
+    """Fit dT/dt = -loss * (T - oat) + gain * pump to the logged data
+    """
+    flow = data['flow']
+    dT = np.diff(flow) / data['step']
+    X = np.column_stack([-(flow - data['oat'])[:-1], data['pump'][:-1]])
+    valid = np.isfinite(dT) & np.isfinite(X).all(axis=1)
+    if valid.sum() < 100 or not (X[valid, 1] > 0).any():
+        return dict(DEFAULT_PLANT)
+    (loss, gain), _, _, _ = np.linalg.lstsq(X[valid], dT[valid], rcond=None)
+    if loss <= 0 or gain <= 0:
+        return dict(DEFAULT_PLANT)
+    return {"loss": float(loss), "gain": float(gain)}
+
+
+def simulate(settings, data, plant=None, band=None, required=None,
+             forecast=None):
+    """Run the regler control functions over the data
+
+    With a plant the flow temperature is simulated, without it the logged
+    flow temperature is replayed. Band violations are counted against the
+    tolerance unless a fixed band is given. With the required flow
+    temperature of every step the comfort violations are counted too.
+    """
+    clock = VirtualClock()
+    regler.clock = clock
+    regler.forecast = forecast or Forecast()
+    zone = regler.zones[regler.DEFAULT_ZONE]
+    zone.reset()
+    regler.outside_air_temp.reset()
+    state = zone.state
+    state['settings'] = dict(settings)
+    state['nominal'] = None
+    state['heat_pump'] = regler.PUMP_OFF
+    state['heat_pump_ts'] = None
+    oatSensor = zone.sensors['outside_air_temp']
+    flowSensor = zone.sensors['flow']
+    if band is None:
+        band = float(settings['tolerance'])
+    step = data['step']
+    timestamps = data['ts'].tolist()
+    oats = data['oat'].tolist()
+    flows = data['flow'].tolist()
+    flow = next((f for f in flows if f == f), None)
+    if required is None:
+        required = itertools.repeat(None)
+    starts = onSteps = violations = comfort = 0
+    lift = 0.0
+    pump = regler.PUMP_OFF
+    for ts, oat, logged, needed in zip(timestamps, oats, flows, required):
+        clock.now = ts
+        if plant is None:
+            flow = logged if logged == logged else None
+        oatSensor.setValue(oat if oat == oat else None)
+        flowSensor.setValue(flow)
+        regler.calculateNominal(zone)
+        regler.calulateHeatPumpState(zone)
+        if state['heat_pump'] != pump:
+            pump = state['heat_pump']
+            if pump == regler.PUMP_ON:
+                starts += 1
+        nominal = state['nominal']
+        if flow is not None and nominal is not None:
+            if abs(flow - nominal) > band:
+                violations += 1
+            if pump == regler.PUMP_ON:
+                onSteps += 1
+                if oat == oat:
+                    lift += max(0.0, flow - oat) * step
+        if flow is not None and needed is not None and needed == needed:
+            if abs(flow - needed) > band:
+                comfort += 1
+        if plant is not None and flow is not None and oat == oat:
+            flow += step * (
+                plant['gain'] * pump - plant['loss'] * (flow - oat))
+    days = max(len(timestamps) * step / 86400.0, 1.0 / 24)
+    result = {
+        "a": settings['a'],
+        "b": settings['b'],
+        "tolerance": settings['tolerance'],
+        "starts": starts,
+        "starts_per_day": round(starts / days, 2),
+        "on_hours": round(onSteps * step / 3600.0, 2),
+        "band_violations": round(violations / max(len(timestamps), 1), 4),
+        "lift_kh": round(lift / 3600.0, 1),
+    }
+    if not isinstance(required, itertools.repeat):
+        result["comfort_violations"] = round(
+            comfort / max(len(timestamps), 1), 4)
+    return result
+
+
+DATA = None
+PLANT = None
+BAND = None
+REQUIRED = None
+
+
+def initWorker(data, plant, band, required=None):
+    global DATA, PLANT, BAND, REQUIRED
+    DATA = data
+    PLANT = plant
+    BAND = band
+    REQUIRED = required
+
+
+def simulateCandidate(settings):
+    return simulate(settings, DATA, PLANT, BAND, REQUIRED)
+
+
+def sweep(candidates, data, plant=None, workers=None, band=None,
+          required=None):
+    """Simulate all candidate settings in a process pool
+    """
+    pool = multiprocessing.Pool(
+        workers, initializer=initWorker,
+        initargs=(data, plant, band, required))
+    try:
+        return pool.map(simulateCandidate, candidates, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def parseCandidates(value, default):
+    """Parse "-0.2,-0.1" or "start:stop:step", stop is included
+    """
+    if not value:
+        return [default]
+    if ':' in value:
+        start, stop, step = [float(v) for v in value.split(':')]
+        return [round(float(v), 6)
+                for v in np.arange(start, stop + step / 2, step)]
+    return [float(v) for v in value.split(',')]
+
+
+def candidateSettings(base, aList, bList, toleranceList):
+    for a, b, tolerance in itertools.product(aList, bList, toleranceList):
+        settings = dict(base)
+        settings.update({"a": a, "b": b, "tolerance": tolerance})
+        yield settings
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    base = SettingsStore(arguments['--settings']).latest()
+    if base is None:
+        base = dict(regler.state['settings'])
+    start = end = None
+    if arguments['--from']:
+        start = parseTimestamp(arguments['--from'])
+    if arguments['--to']:
+        end = parseTimestamp(arguments['--to'])
+    data = loadData(arguments['--log'], start, end, int(arguments['--step']))
+    plant = None
+    if arguments['--plant'] == 'model':
+        plant = fitPlant(data)
+        sys.stderr.write('plant: %s\n' % plant)
+    candidates = list(candidateSettings(
+        base,
+        parseCandidates(arguments['--a'], float(base['a'])),
+        parseCandidates(arguments['--b'], float(base['b'])),
+        parseCandidates(arguments['--tolerance'], float(base['tolerance'])),
+    ))
+    workers = None
+    if arguments['--workers']:
+        workers = int(arguments['--workers'])
+    results = sweep(candidates, data, plant, workers or os.cpu_count())
+    results.sort(key=lambda r: (r['starts'], r['band_violations']))
+    out = csv.DictWriter(sys.stdout, METRICS)
+    out.writeheader()
+    out.writerows(results)
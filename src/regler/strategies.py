@@ -0,0 +1,181 @@
+"""
+strategies - Control strategies for the heat pump
+
+The strategy is selected with the `mode` setting. A strategy only decides
+the wanted pump state from valid values, regler still switches the pump off
+for missing values and high outside air temperatures and applies the guard
+against short cycling.
+
+Settings used by the strategies, all optional except a and tolerance:
+
+    hysteresis  tolerance
+    pi          tolerance, kp [1/K], ki [1/(K*s)], period [s]
+    predictive  a, tolerance, horizon [s], trend_window [s]
+"""
+import time
+import logging
+from collections import deque
+
+
+PUMP_ON = 1
+PUMP_OFF = 0
+
+
+class Strategy(object):
+
+    name = None
+
+    def __init__(self):
+        self.wanted = None
+        self.decisions = 0
+        self.cycles = 0
+        self.latency = 0.0
+        self.maxLatency = 0.0
+
+    def decide(self, pump, current, nominal, oat, settings, now):
+        start = time.perf_counter()
+        wanted = self.calculate(pump, current, nominal, oat, settings, now)
+        self.latency = (time.perf_counter() - start) * 1000.0
+        self.maxLatency = max(self.maxLatency, self.latency)
+        self.decisions += 1
+        if wanted == PUMP_ON and self.wanted != PUMP_ON:
+            self.cycles += 1
+        self.wanted = wanted
+        logging.debug('%s: wanted %s in %.3fms',
+                      self.name, wanted, self.latency)
+        return wanted
+
+    def calculate(self, pump, current, nominal, oat, settings, now):
+        raise NotImplementedError()
+
+    def report(self):
+        # only values which rarely change, the state is published on change
+        return {
+            "name": self.name,
+            "cycles": self.cycles,
+            "max_latency_ms": round(self.maxLatency, 1),
+        }
+
+
+class Hysteresis(Strategy):
+    """Switch on below and off above the tolerance band
+    """
+
+    name = 'hysteresis'
+
+    def calculate(self, pump, current, nominal, oat, settings, now):
+        tolerance = float(settings['tolerance'])
+        if pump == PUMP_ON and current > (nominal + tolerance):
+            return PUMP_OFF
+        if pump == PUMP_OFF and current < (nominal - tolerance):
+            return PUMP_ON
+        return pump
+
+
+class PI(Strategy):
+    """PI controller with a time proportioned output
+
+    The controller output is the duty cycle of the pump. It is fixed at the
+    start of each period so the pump starts at most once per period. The
+    integral is only updated while the output isn't saturated or the error
+    drives it back (conditional integration against windup).
+    """
+
+    name = 'pi'
+
+    def __init__(self):
+        super(PI, self).__init__()
+        self.integral = 0.0
+        self.last = None
+        self.periodStart = None
+        self.duty = 0.0
+
+    def calculate(self, pump, current, nominal, oat, settings, now):
+        kp = float(settings.get('kp', 0.3))
+        ki = float(settings.get('ki', 0.0001))
+        period = float(settings.get('period', 1800))
+        tolerance = float(settings['tolerance'])
+        error = nominal - current
+        dt = 0.0
+        if self.last is not None:
+            dt = min(max(now - self.last, 0.0), period)
+        self.last = now
+        integral = self.integral + error * dt
+        u = kp * error + ki * integral
+        if (0.0 < u < 1.0 or (u >= 1.0 and error < 0)
+                or (u <= 0.0 and error > 0)):
+            self.integral = integral
+        u = min(max(kp * error + ki * self.integral, 0.0), 1.0)
+        if self.periodStart is None or (now - self.periodStart) >= period:
+            self.periodStart = now
+            self.duty = u
+        if current > (nominal + tolerance):
+            # never heat above the band, end the on phase of this period
+            self.duty = 0.0
+            return PUMP_OFF
+        if (now - self.periodStart) < self.duty * period:
+            return PUMP_ON
+        return PUMP_OFF
+
+
+class Predictive(Hysteresis):
+    """Hysteresis on the nominal of the predicted outside air temperature
+
+    The trend of the outside air temperature is a least squares slope over
+    the last trend window, the nominal is moved along the heating curve to
+    the temperature expected after the horizon.
+    """
+
+    name = 'predictive'
+
+    SAMPLES = 60
+
+    def __init__(self):
+        super(Predictive, self).__init__()
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def trend(self, oat, now, window):
+        if not self.samples or (now - self.samples[-1][0]) >= (
+                window / self.SAMPLES):
+            self.samples.append((now, oat))
+        samples = [s for s in self.samples if (now - s[0]) <= window]
+        if len(samples) < 2:
+            return 0.0
+        n = float(len(samples))
+        mt = sum(s[0] for s in samples) / n
+        mv = sum(s[1] for s in samples) / n
+        var = sum((s[0] - mt) ** 2 for s in samples)
+        if not var:
+            return 0.0
+        return sum((s[0] - mt) * (s[1] - mv) for s in samples) / var
+
+    def calculate(self, pump, current, nominal, oat, settings, now):
+        horizon = float(settings.get('horizon', 3600))
+        window = float(settings.get('trend_window', 3600))
+        predicted = oat + self.trend(oat, now, window) * horizon
+        nominal += float(settings['a']) * (predicted - oat)
+        return super(Predictive, self).calculate(
+            pump, current, nominal, oat, settings, now)
+
+
+STRATEGIES = {
+    'auto': Hysteresis,
+    'hysteresis': Hysteresis,
+    'pi': PI,
+    'predictive': Predictive,
+}
+
+
+def getStrategy(mode, instances):
+    """The strategy instance for a mode, unknown modes use hysteresis
+
+    Every heating circuit has its own instances, the controllers keep
+    state.
+    """
+    strategy = instances.get(mode)
+    if strategy is None:
+        if mode not in STRATEGIES:
+            logging.warning('unknown mode %r, using hysteresis', mode)
+        strategy = STRATEGIES.get(mode, Hysteresis)()
+        instances[mode] = strategy
+    return strategy
@@ -0,0 +1,133 @@
+"""
+supervisor - Run several services in one process
+Usage:
+    supervisor [-h | --help]
+    supervisor [options] [<component>...]
+
+Options:
+    -h --help           Show this screen.
+    --uri=<mqttclient>  MQTT broker URI [default: mqtt://localhost]
+    --log=FILE          Logfile [default: /var/log/house/supervisor.log]
+    --bridge=LIST       topics sent to the broker, e.g. "#" for all,
+                        defaults to the topics of hassio and the display
+    -v                  log level DEBUG
+
+Components are regler, sensorreader, pumpswitch, hassio, mqttlogger and
+sensorlogger, all except sensorlogger are started without a component.
+Options of a component follow its name after a colon, e.g.
+
+    supervisor regler:"--zones=upstairs --loop-time=60" pumpswitch
+
+The components exchange messages through the in-process bus, only the
+bridged topics are published to the broker. All components share one MQTT
+connection. A component which stops or fails is restarted on its own after
+a few seconds.
+"""
+import shlex
+import signal
+import asyncio
+import logging
+import importlib
+
+import docopt
+
+from bus import Bus, EXTERNAL
+
+
+COMPONENTS = [
+    'regler', 'sensorreader', 'pumpswitch', 'hassio', 'mqttlogger',
+    'sensorlogger',
+]
+DEFAULT_COMPONENTS = [
+    'regler', 'sensorreader', 'pumpswitch', 'hassio', 'mqttlogger',
+]
+
+# seconds, like RestartSec of the systemd services
+RESTART_DELAY = 3
+
+# seconds the components get to shut down
+STOP_TIMEOUT = 10
+
+
+def parseComponent(spec, uri):
+    """Split "name:options" into the module and its arguments
+    """
+    name, _, options = spec.partition(':')
+    if name not in COMPONENTS:
+        raise docopt.DocoptExit('unknown component %r' % name)
+    module = importlib.import_module(name)
+    argv = shlex.split(options)
+    if '--uri' in module.__doc__ and not any(
+            a.startswith('--uri') for a in argv):
+        argv.append('--uri=' + uri)
+    arguments = docopt.docopt(module.__doc__, argv=argv)
+    return name, module, arguments
+
+
+@asyncio.coroutine
+def supervise(name, module, arguments, bus):
+    module.client_factory = bus.clientFactory
+    module.arguments = arguments
+    while True:
+        try:
+            yield from module.run(arguments)
+            logging.warning('%s stopped', name)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception('%s failed: %s', name, e)
+        if bus.stopping:
+            return
+        yield from asyncio.sleep(RESTART_DELAY)
+        logging.info('restarting %s', name)
+
+
+@asyncio.coroutine
+def run(arguments):
+    uri = arguments['--uri']
+    components = [
+        parseComponent(spec, uri)
+        for spec in arguments['<component>'] or DEFAULT_COMPONENTS
+    ]
+    external = EXTERNAL
+    if arguments['--bridge']:
+        external = [t.strip() for t in arguments['--bridge'].split(',')]
+    bus = Bus(uri, external)
+    tasks = [asyncio.ensure_future(bus.run())]
+    for name, module, args in components:
+        logging.info('starting %s', name)
+        tasks.append(asyncio.ensure_future(
+            supervise(name, module, args, bus)))
+    try:
+        yield from asyncio.gather(*tasks)
+    finally:
+        bus.stopping = True
+        for task in tasks:
+            task.cancel()
+        yield from asyncio.wait(tasks, timeout=STOP_TIMEOUT)
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    level = logging.INFO
+    if arguments['-v']:
+        level = logging.DEBUG
+    logging.basicConfig(
+        filename=arguments['--log'],
+        format='%(asctime)s:%(name)s:%(message)s',
+        level=level,
+    )
+    loop = asyncio.get_event_loop()
+    main = asyncio.ensure_future(run(arguments))
+    # systemd stops with SIGTERM
+    loop.add_signal_handler(signal.SIGTERM, main.cancel)
+    try:
+        loop.run_until_complete(main)
+    except KeyboardInterrupt:
+        main.cancel()
+        try:
+            loop.run_until_complete(main)
+        except asyncio.CancelledError:
+            pass
+    except asyncio.CancelledError:
+        pass
@@ -0,0 +1,96 @@
+"""
+topictree - Dispatch MQTT topics to handlers
+
+Handlers are registered for MQTT topic filters including the `+` and `#`
+wildcards. The filters are stored in a tree with one node per topic level,
+so matching a topic only walks its levels and doesn't depend on the number
+of registered handlers.
+"""
+
+
+class Node(object):
+
+    __slots__ = ('children', 'handlers')
+
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+class TopicRouter(object):
+
+    def __init__(self, routes=()):
+        self.root = Node()
+        self.filters = []
+        for topicFilter, handler in routes:
+            self.add(topicFilter, handler)
+
+    def add(self, topicFilter, handler):
+        levels = topicFilter.split('/')
+        for i, level in enumerate(levels):
+            if level == '#' and i != len(levels) - 1:
+                raise ValueError(
+                    "'#' must be the last level in %r" % topicFilter)
+        node = self.root
+        for level in levels:
+            node = node.children.setdefault(level, Node())
+        node.handlers.append(handler)
+        if topicFilter not in self.filters:
+            self.filters.append(topicFilter)
+
+    def remove(self, topicFilter, handler):
+        node = self.root
+        for level in topicFilter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return
+        if handler in node.handlers:
+            node.handlers.remove(handler)
+        if not node.handlers and topicFilter in self.filters:
+            self.filters.remove(topicFilter)
+
+    def match(self, topic):
+        """Return all handlers whose filter matches the topic
+        """
+        result = []
+        levels = topic.split('/')
+        nodes = [self.root]
+        for depth, level in enumerate(levels):
+            # wildcards don't match topics starting with '$'
+            wildcards = depth > 0 or not level.startswith('$')
+            next_nodes = []
+            for node in nodes:
+                children = node.children
+                if wildcards:
+                    multi = children.get('#')
+                    if multi is not None:
+                        result.extend(multi.handlers)
+                    single = children.get('+')
+                    if single is not None:
+                        next_nodes.append(single)
+                child = children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                return result
+        for node in nodes:
+            result.extend(node.handlers)
+            # 'a/#' also matches 'a'
+            multi = node.children.get('#')
+            if multi is not None:
+                result.extend(multi.handlers)
+        return result
+
+    def dispatch(self, topic, *args):
+        """Call all handlers matching the topic, returns the number of calls
+        """
+        handlers = self.match(topic)
+        for handler in handlers:
+            handler(topic, *args)
+        return len(handlers)
+
+    def subscriptions(self, qos):
+        """The filters in the format expected by MQTTClient.subscribe
+        """
+        return [(f, qos) for f in self.filters]
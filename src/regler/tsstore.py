@@ -0,0 +1,427 @@
+"""
+tsstore - Compact binary storage for logged sensor data
+Usage:
+    tsstore [-h | --help]
+    tsstore convert <store> <csvfile>...
+    tsstore topics <store>
+    tsstore query <store> <topic> [--from=TS] [--to=TS]
+
+Options:
+    -h --help           Show this screen.
+    --from=TS           first timestamp, e.g. 2019-11-16T00:00:00Z
+    --to=TS             last timestamp
+
+The store is a single append only file. Topics are stored once in a topic
+dictionary, the samples of a topic are grouped in chunks of a fixed number
+of rows holding delta encoded timestamps (seconds) and float32 values.
+
+The rows of unfinished chunks are appended to <store>.journal on every
+flush, only those added since the last flush, and appended again when the
+store is opened after a crash. A block torn
+by a crash is cut off before new blocks are appended, as is garbage after
+the last complete block, e.g. the zeros left by a power loss.
+
+Layout, all integers little endian and all blocks 8 byte aligned:
+
+    header  "HZTS" u16 version, u16 reserved
+    topic   "T" pad u16 id, u32 length, utf-8 name padded to 8 bytes
+    chunk   "C" pad u16 topic id, u32 count, i64 first ts, i64 last ts,
+            u32[count] ts deltas, f32[count] values, padding to 8 bytes
+"""
+import os
+import csv
+import sys
+import json
+import logging
+import mmap
+import time
+import array
+import bisect
+import struct
+import calendar
+import contextlib
+import docopt
+from datetime import datetime
+
+
+MAGIC = b'HZTS'
+VERSION = 1
+CHUNK_SIZE = 1024
+
+HEADER = struct.Struct('<4sHH')
+TOPIC = struct.Struct('<cxHI')
+CHUNK = struct.Struct('<cxHIqq')
+
+
+def parseTimestamp(ts):
+    """Convert a logged timestamp like `2019-11-16T11:19:46Z` to seconds
+    """
+    ts = ts.strip().rstrip('Z')
+    if '.' in ts:
+        ts = ts.split('.', 1)[0]
+    return calendar.timegm(
+        datetime.strptime(ts, '%Y-%m-%dT%H:%M:%S').timetuple())
+
+
+def formatTimestamp(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+
+def padding(length):
+    return -length % 8
+
+
+class TimeSeriesWriter(object):
+
+    def __init__(self, path, chunkSize=CHUNK_SIZE):
+        self.chunkSize = chunkSize
+        self.topics = {}
+        self.journalPath = path + '.journal'
+        journal = []
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with TimeSeriesReader(path) as reader:
+                self.topics = dict(reader.topicIds)
+                end = reader.end
+                journal = self.readJournal(reader)
+            size = os.path.getsize(path)
+            if end < size:
+                logging.warning(
+                    'tsstore: %s ends with an incomplete block, %s bytes '
+                    'cut off', path, size - end)
+                os.truncate(path, end)
+            self.file = open(path, 'ab')
+        else:
+            self.file = open(path, 'ab')
+            self.file.write(HEADER.pack(MAGIC, VERSION, 0))
+        # topic id -> ([ts], [value]) not yet written
+        self.pending = {}
+        # topic id -> number of pending rows in the journal
+        self.journaled = {}
+        # rows in the journal, most of them are in the store later
+        self.journalRows = 0
+        for topic, timestamps, values in journal:
+            for ts, value in zip(timestamps, values):
+                self.append(topic, ts, value)
+        if journal or os.path.exists(self.journalPath):
+            self.writeJournal()
+
+    def readJournal(self, reader):
+        """The pending rows of the last run which are not in the store
+
+        Every line holds the size of the store at a flush and the rows
+        added before it, a torn last line is ignored.
+        """
+        result = []
+        try:
+            with open(self.journalPath, 'r') as f:
+                lines = f.readlines()
+        except IOError:
+            return result
+        for line in lines:
+            try:
+                size, rows = json.loads(line)
+            except ValueError:
+                continue
+            for topic, (timestamps, values) in rows.items():
+                topicId = reader.topicIds.get(topic)
+                # a chunk written after the line holds all its rows
+                if topicId is not None and any(
+                        offset >= size
+                        for first, last, offset, count
+                        in reader.chunks.get(topicId, [])):
+                    continue
+                result.append((topic, timestamps, values))
+        return result
+
+    def journalLine(self, rows):
+        names = dict((topicId, t) for t, topicId in self.topics.items())
+        return json.dumps([
+            self.file.tell(),
+            dict((names[topicId], r) for topicId, r in rows),
+        ]) + '\n'
+
+    def writeJournal(self):
+        """Replace the journal by the pending rows
+        """
+        tmp = self.journalPath + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.journalLine(self.pending.items()))
+        os.replace(tmp, self.journalPath)
+        self.journaled = dict(
+            (topicId, len(rows[0])) for topicId, rows in self.pending.items())
+        self.journalRows = sum(self.journaled.values())
+
+    def appendJournal(self):
+        """Append the rows added since the last flush
+        """
+        added = []
+        for topicId, rows in self.pending.items():
+            n = self.journaled.get(topicId, 0)
+            if n < len(rows[0]):
+                added.append((topicId, (rows[0][n:], rows[1][n:])))
+                self.journaled[topicId] = len(rows[0])
+        if not added:
+            return
+        count = sum(len(rows[0]) for topicId, rows in added)
+        pending = sum(len(rows[0]) for rows in self.pending.values())
+        if self.journalRows + count > 2 * pending + self.chunkSize:
+            # most rows of the journal are in the store by now
+            self.writeJournal()
+            return
+        with open(self.journalPath, 'a') as f:
+            f.write(self.journalLine(added))
+        self.journalRows += count
+
+    def topicId(self, topic):
+        topicId = self.topics.get(topic)
+        if topicId is None:
+            topicId = len(self.topics)
+            self.topics[topic] = topicId
+            name = topic.encode('utf-8')
+            self.file.write(TOPIC.pack(b'T', topicId, len(name)))
+            self.file.write(name + b'\0' * padding(len(name)))
+        return topicId
+
+    def append(self, topic, ts, value):
+        topicId = self.topicId(topic)
+        rows = self.pending.setdefault(topicId, ([], []))
+        if rows[0] and ts < rows[0][-1]:
+            # deltas are unsigned, out of order data starts a new chunk
+            self.writeChunk(topicId, *rows)
+            rows = self.pending[topicId] = ([], [])
+            self.journaled.pop(topicId, None)
+        rows[0].append(int(ts))
+        rows[1].append(value)
+        if len(rows[0]) >= self.chunkSize:
+            self.writeChunk(topicId, *rows)
+            del self.pending[topicId]
+            self.journaled.pop(topicId, None)
+
+    def appendRow(self, ts, value, topic):
+        """Append a logged row, returns False for non numeric values
+        """
+        try:
+            value = float(value)
+            ts = parseTimestamp(ts)
+        except ValueError:
+            return False
+        self.append(topic, ts, value)
+        return True
+
+    def writeChunk(self, topicId, timestamps, values):
+        count = len(timestamps)
+        if not count:
+            return
+        deltas = array.array('I', [0])
+        deltas.extend(b - a for a, b in zip(timestamps, timestamps[1:]))
+        data = deltas.tobytes() + array.array('f', values).tobytes()
+        self.file.write(CHUNK.pack(
+            b'C', topicId, count, timestamps[0], timestamps[-1]))
+        self.file.write(data + b'\0' * padding(len(data)))
+
+    def flush(self, partial=False):
+        """Write pending rows
+
+        Only full chunks are written while running, partial chunks would
+        fragment the file. The rows of partial chunks added since the last
+        flush are appended to the journal, all are written on close.
+        """
+        if partial:
+            for topicId, rows in self.pending.items():
+                self.writeChunk(topicId, *rows)
+            self.pending = {}
+            self.journaled = {}
+        self.file.flush()
+        self.appendJournal()
+
+    def close(self):
+        self.flush(partial=True)
+        self.file.close()
+        if os.path.exists(self.journalPath):
+            os.remove(self.journalPath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def openWriter(path):
+    """A writer for the path or a context returning None if there is none
+    """
+    if path:
+        return TimeSeriesWriter(path)
+    return contextlib.nullcontext()
+
+
+class TimeSeriesReader(object):
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.topicIds = {}
+        # topic id -> sorted list of (first ts, last ts, offset, count)
+        self.chunks = {}
+        # topic id -> running max of the last ts of the sorted chunks
+        self.lasts = {}
+        # end of the last complete block
+        self.end = HEADER.size
+        self.mm = None
+        if os.fstat(self.file.fileno()).st_size == 0:
+            return
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _ = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a time series store' % path)
+        self.scan()
+
+    def scan(self):
+        mm = self.mm
+        size = len(mm)
+        offset = HEADER.size
+        while offset + TOPIC.size <= size:
+            kind = mm[offset:offset + 1]
+            if kind == b'T':
+                _, topicId, length = TOPIC.unpack_from(mm, offset)
+                start = offset + TOPIC.size
+                end = start + length + padding(length)
+                if end > size:
+                    break
+                name = bytes(mm[start:start + length]).decode('utf-8')
+                self.topicIds[name] = topicId
+            elif kind == b'C':
+                if offset + CHUNK.size > size:
+                    break
+                _, topicId, count, first, last = CHUNK.unpack_from(
+                    mm, offset)
+                start = offset + CHUNK.size
+                end = start + count * 8 + padding(count * 8)
+                if end > size:
+                    # incomplete chunk from an interrupted write
+                    break
+                self.chunks.setdefault(topicId, []).append(
+                    (first, last, start, count))
+            elif self.blockFollows(offset + 8):
+                raise ValueError('corrupt block at offset %s' % offset)
+            else:
+                # torn write at the end, e.g. zeros after a power loss
+                break
+            offset = self.end = end
+        for topicId, chunks in self.chunks.items():
+            chunks.sort()
+            lasts = self.lasts[topicId] = []
+            for chunk in chunks:
+                lasts.append(max(chunk[1], lasts[-1] if lasts else chunk[1]))
+
+    def blockFollows(self, offset):
+        """True if a complete block starts at an aligned offset from here
+        """
+        mm = self.mm
+        size = len(mm)
+        for offset in range(offset, size - TOPIC.size + 1, 8):
+            kind = mm[offset:offset + 1]
+            if kind == b'T':
+                _, topicId, length = TOPIC.unpack_from(mm, offset)
+                start = offset + TOPIC.size
+                if 0 < length and start + length <= size:
+                    try:
+                        bytes(mm[start:start + length]).decode('utf-8')
+                        return True
+                    except UnicodeDecodeError:
+                        pass
+            elif kind == b'C' and offset + CHUNK.size <= size:
+                _, topicId, count, first, last = CHUNK.unpack_from(
+                    mm, offset)
+                end = offset + CHUNK.size + count * 8
+                if 0 < count and first <= last and end <= size:
+                    return True
+        return False
+
+    def topics(self):
+        return sorted(self.topicIds)
+
+    def chunksFor(self, topic, start=None, end=None):
+        topicId = self.topicIds.get(topic)
+        chunks = self.chunks.get(topicId, [])
+        first = 0
+        if start is not None and chunks:
+            # chunks may overlap, e.g. out of order rows or a log converted
+            # twice, skip the chunks before the first one reaching start
+            first = bisect.bisect_left(self.lasts[topicId], start)
+        for chunk in chunks[first:]:
+            if end is not None and chunk[0] > end:
+                break
+            if start is not None and chunk[1] < start:
+                continue
+            yield chunk
+
+    def query(self, topic, start=None, end=None):
+        """Yield (ts, value) of a topic in the range [start, end]
+        """
+        mm = self.mm
+        for first, last, offset, count in self.chunksFor(topic, start, end):
+            # only the pages of the selected chunks are read
+            deltas = array.array('I')
+            deltas.frombytes(mm[offset:offset + count * 4])
+            values = array.array('f')
+            values.frombytes(mm[offset + count * 4:offset + count * 8])
+            ts = first
+            for i in range(count):
+                ts += deltas[i]
+                if start is not None and ts < start:
+                    continue
+                if end is not None and ts > end:
+                    break
+                yield ts, values[i]
+
+    def close(self):
+        if self.mm is not None:
+            self.mm.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def convertCSV(paths, writer):
+    """Convert logs written by sensorlogger/mqttlogger
+
+    Returns the number of converted and skipped rows, non numeric values
+    like the JSON state can't be stored.
+    """
+    converted = skipped = 0
+    for path in paths:
+        with open(path, 'r', newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 3:
+                    skipped += 1
+                elif writer.appendRow(row[0], row[1], row[-1]):
+                    converted += 1
+                else:
+                    skipped += 1
+    return converted, skipped
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+    if arguments['convert']:
+        with TimeSeriesWriter(arguments['<store>']) as writer:
+            converted, skipped = convertCSV(arguments['<csvfile>'], writer)
+        print('converted %s rows, skipped %s' % (converted, skipped))
+    elif arguments['topics']:
+        with TimeSeriesReader(arguments['<store>']) as reader:
+            for topic in reader.topics():
+                print(topic)
+    elif arguments['query']:
+        start = end = None
+        if arguments['--from']:
+            start = parseTimestamp(arguments['--from'])
+        if arguments['--to']:
+            end = parseTimestamp(arguments['--to'])
+        with TimeSeriesReader(arguments['<store>']) as reader:
+            out = csv.writer(sys.stdout)
+            for ts, value in reader.query(arguments['<topic>'], start, end):
+                out.writerow([formatTimestamp(ts), '%.7g' % value])